@@ -1,14 +1,54 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import codecs
+import gzip
+import hashlib
+import importlib
 import io
+import json
+import mmap
+import multiprocessing
 import os
 import re
 import shutil
+import sqlite3
+import stat
 import subprocess
 import sys
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Set
+from types import ModuleType
+from typing import (
+    AbstractSet, Any, Awaitable, BinaryIO, Callable, Dict, FrozenSet, Iterable, List, NamedTuple,
+    Optional, Sequence, Set, Tuple, Union,
+)
 import tokenize
+import venv
+
+TOOL_VERSION = "1.1.0"
+
+TOOL_PACKAGES: Dict[str, Optional[str]] = {
+    "ruff": "ruff", "isort": "isort", "black": "black", "shellcheck": None, "shfmt": None,
+}
+
+STATE_CACHE_DIRNAME = ".cleanup_cache"
+
+STATE_NEUTRAL_ARGS = {
+    "paths", "dry_run", "incremental", "cache_dir", "jobs", "exclude", "no_gitignore",
+    "discovery", "since", "staged", "tool_jobs", "tool_cache", "tool_cache_size",
+    "wheelhouse", "no_prefilter", "fsync", "recheck_stat", "stream_threshold", "stream_chunk",
+}
+
+MIN_FILES_PER_SHARD = 16
+
+MAX_SHARD_ARGV_BYTES = 256 * 1024
 
 SAFE_EXCLUDED_DIRNAMES = {
     ".git", "venv", ".venv", "env", ".env", "build", "dist",
@@ -24,34 +64,384 @@ DEFAULT_KEEP_SH_COMMENT_KEYWORDS = {"shellcheck"}
 
 ENCODING_COOKIE_RE = re.compile(r"coding[:=]\s*([-\.\w]+)")
 
-def discover_source_files(paths: List[Path]) -> Dict[str, List[Path]]:
-    """Находит исходные файлы (.py, .sh, .html, .css, .js) в указанных путях."""
+PREFILTER_MARKERS: Dict[str, Tuple[bytes, ...]] = {
+    "py": (b"#",), "sh": (b"#",), "html": (b"<!--", b"/*", b"//"),
+    "css": (b"/*",), "js": (b"/*", b"//"),
+}
+
+WHITESPACE_MARKERS = (b" \n", b"\t\n", b"\n\n\n", b"\r")
+
+MINIFY_TYPES = frozenset({"html", "css", "js"})
+
+MMAP_THRESHOLD = 1024 * 1024
+
+GCC_DIAGNOSTIC_RE = re.compile(r"^(.*?):\d+:\d+: ")
+
+SUPPORTED_SUFFIXES = {
+    ".py": "py", ".sh": "sh", ".html": "html",
+    ".css": "css", ".js": "js", ".svg": "svg",
+}
+
+def default_workers() -> int:
+    """Возвращает число потоков по умолчанию для операций ввода-вывода."""
+    return min(32, (os.cpu_count() or 1) + 4)
+
+def classify_name(name: str) -> Optional[str]:
+    """Определяет тип файла по имени без создания Path (как Path.suffix)."""
+    dot = name.rfind(".")
+    if 0 < dot < len(name) - 1:
+        return SUPPORTED_SUFFIXES.get(name[dot:])
+    return None
+
+def is_excluded_dirname(name: str) -> bool:
+    """Проверяет, нужно ли пропустить каталог при обходе."""
+    return name in SAFE_EXCLUDED_DIRNAMES or name.startswith(".")
+
+IgnoreRule = Tuple["re.Pattern[str]", bool, bool]
+
+def translate_ignore_pattern(pattern: str) -> str:
+    """Переводит шаблон в синтаксисе .gitignore в регулярное выражение."""
+    out: List[str] = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/"):
+                if i + 2 == n:
+                    out.append(".*")
+                    i += 2
+                    continue
+                if pattern[i + 2] == "/":
+                    out.append("(?:.*/)?")
+                    i += 3
+                    continue
+            while i + 1 < n and pattern[i + 1] == "*":
+                i += 1
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and pattern.find("]", i + 2) > 0:
+            j = pattern.find("]", i + 2)
+            body = pattern[i + 1:j].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append(f"[{body}]")
+            i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+def parse_ignore_pattern(line: str, base_rel: str) -> Optional[IgnoreRule]:
+    """Разбирает строку .gitignore; base_rel — каталог файла относительно корня обхода."""
+    line = line.rstrip("\r\n")
+    if not line or line.startswith("#"):
+        return None
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    line = stripped
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    anchored = "/" in line
+    prefix = re.escape(base_rel + "/") if base_rel else ""
+    if not anchored:
+        prefix += "(?:.*/)?"
+    regex = prefix + translate_ignore_pattern(line.lstrip("/")) + r"\Z"
+    return re.compile(regex, re.DOTALL), negate, dir_only
+
+def read_ignore_file(path: str, base_rel: str) -> Tuple[IgnoreRule, ...]:
+    """Читает правила из файла .gitignore (или .git/info/exclude)."""
+    try:
+        with open(path, encoding="utf-8", errors="replace") as fh:
+            lines = fh.readlines()
+    except OSError:
+        return ()
+    rules = (parse_ignore_pattern(line, base_rel) for line in lines)
+    return tuple(rule for rule in rules if rule is not None)
+
+class IgnoreMatcher:
+    """Скомпилированные правила исключения для одного уровня каталогов."""
+
+    def __init__(self, rules: Tuple[IgnoreRule, ...] = ()):
+        self.rules = rules
+        self.has_negation = any(negate for _, negate, _ in rules)
+        self.any_dir = self._combine(r for r, negate, _ in rules if not negate)
+        self.any_file = self._combine(
+            r for r, negate, dir_only in rules if not negate and not dir_only
+        )
+
+    @staticmethod
+    def _combine(patterns: Iterable["re.Pattern[str]"]) -> Optional["re.Pattern[str]"]:
+        sources = [f"(?:{p.pattern})" for p in patterns]
+        return re.compile("|".join(sources), re.DOTALL) if sources else None
+
+    def extend(self, rules: Tuple[IgnoreRule, ...]) -> "IgnoreMatcher":
+        """Возвращает матчер для вложенного уровня с дополнительными правилами."""
+        return IgnoreMatcher(self.rules + rules) if rules else self
+
+    def is_ignored(self, rel_path: str, is_dir: bool) -> bool:
+        """Проверяет путь (относительно корня обхода) по правилам; последнее совпадение побеждает."""
+        quick = self.any_dir if is_dir else self.any_file
+        if quick is None or quick.match(rel_path) is None:
+            return False
+        if not self.has_negation:
+            return True
+        ignored = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                ignored = not negate
+        return ignored
+
+def find_git_toplevel(path: Path) -> Optional[Path]:
+    """Ищет ближайший каталог с .git среди path и его родителей."""
+    for candidate in (path, *path.parents):
+        if (candidate / ".git").exists():
+            return candidate
+    return None
+
+def relative_posix(path: Path, anchor: Path) -> str:
+    """Возвращает путь относительно anchor в виде a/b ("" для самого anchor)."""
+    rel = path.relative_to(anchor).as_posix()
+    return "" if rel == "." else rel
+
+def build_root_matcher(
+    root: Path, excludes: List[str], use_gitignore: bool
+) -> Tuple[Optional[IgnoreMatcher], str]:
+    """Строит матчер для корня обхода и возвращает путь корня относительно точки отсчёта правил."""
+    if not use_gitignore and not excludes:
+        return None, ""
+    anchor = root
+    rules: Tuple[IgnoreRule, ...] = ()
+    if use_gitignore:
+        anchor = find_git_toplevel(root) or root
+        rules += read_ignore_file(str(anchor / ".git" / "info" / "exclude"), "")
+        for ancestor in reversed(root.parents):
+            if ancestor == anchor or anchor in ancestor.parents:
+                rules += read_ignore_file(
+                    str(ancestor / ".gitignore"), relative_posix(ancestor, anchor)
+                )
+    root_rel = relative_posix(root, anchor)
+    for pattern in excludes:
+        rule = parse_ignore_pattern(pattern, root_rel)
+        if rule is not None:
+            rules += (rule,)
+    return IgnoreMatcher(rules), root_rel
+
+def scan_directory(
+    dir_path: str,
+    rel_dir: str = "",
+    matcher: Optional[IgnoreMatcher] = None,
+    use_gitignore: bool = False,
+) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]], Optional[IgnoreMatcher]]:
+    """Читает один каталог через os.scandir: возвращает (файлы, подкаталоги, матчер уровня)."""
+    files: List[Tuple[str, str]] = []
+    subdirs: List[Tuple[str, str]] = []
+    if matcher is not None and use_gitignore:
+        matcher = matcher.extend(read_ignore_file(os.path.join(dir_path, ".gitignore"), rel_dir))
+    prefix = rel_dir + "/" if rel_dir else ""
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                name = entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if is_excluded_dirname(name) or entry.is_symlink():
+                        continue
+                    if matcher is not None and matcher.is_ignored(prefix + name, True):
+                        continue
+                    subdirs.append((entry.path, prefix + name))
+                    continue
+                file_type = classify_name(name)
+                if file_type is None:
+                    continue
+                if matcher is not None and matcher.is_ignored(prefix + name, False):
+                    continue
+                files.append((entry.path, file_type))
+    except OSError:
+        pass
+    return files, subdirs, matcher
+
+def walk_source_tree(
+    root: str,
+    pool: ThreadPoolExecutor,
+    rel_root: str = "",
+    matcher: Optional[IgnoreMatcher] = None,
+    use_gitignore: bool = False,
+) -> List[Tuple[str, str]]:
+    """Параллельно обходит дерево каталогов, распределяя чтение каталогов по пулу."""
+    found: List[Tuple[str, str]] = []
+    pending = {pool.submit(scan_directory, root, rel_root, matcher, use_gitignore)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            files, subdirs, level_matcher = future.result()
+            found.extend(files)
+            pending.update(
+                pool.submit(scan_directory, path, rel, level_matcher, use_gitignore)
+                for path, rel in subdirs
+            )
+    found.sort()
+    return found
+
+def git_list_files(root: Path, use_gitignore: bool = True) -> Optional[List[str]]:
+    """Возвращает отслеживаемые и неотслеживаемые файлы под root через git ls-files.
+
+    С use_gitignore неотслеживаемые файлы фильтруются по .gitignore (--exclude-standard).
+    """
+    cmd = ["git", "ls-files", "-z", "--cached", "--others"]
+    if use_gitignore:
+        cmd.append("--exclude-standard")
+    try:
+        proc = subprocess.run(cmd, cwd=root, capture_output=True, check=False)
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    return [p for p in os.fsdecode(proc.stdout).split("\0") if p]
+
+def filter_git_paths(
+    root: Path, rel_paths: Iterable[str], matcher: Optional[IgnoreMatcher]
+) -> List[Tuple[str, str]]:
+    """Отбирает исходные файлы из путей, полученных от git (относительно root)."""
+    pruned: Dict[str, bool] = {"": False}
+
+    def is_pruned(rel_dir: str) -> bool:
+        verdict = pruned.get(rel_dir)
+        if verdict is None:
+            slash = rel_dir.rfind("/")
+            verdict = (
+                is_pruned(rel_dir[:max(slash, 0)])
+                or is_excluded_dirname(rel_dir[slash + 1:])
+                or (matcher is not None and matcher.is_ignored(rel_dir, True))
+            )
+            pruned[rel_dir] = verdict
+        return verdict
+
+    found: List[Tuple[str, str]] = []
+    root_str = str(root)
+    for rel in set(rel_paths):
+        slash = rel.rfind("/")
+        file_type = classify_name(rel[slash + 1:])
+        if file_type is None or is_pruned(rel[:max(slash, 0)]):
+            continue
+        if matcher is not None and matcher.is_ignored(rel, False):
+            continue
+        path = os.path.join(root_str, rel)
+        if os.path.isfile(path):
+            found.append((path, file_type))
+    found.sort()
+    return found
+
+def list_source_tree_git(
+    root: Path, matcher: Optional[IgnoreMatcher], use_gitignore: bool = True
+) -> Optional[List[Tuple[str, str]]]:
+    """Находит исходные файлы под root по индексу git; None, если git недоступен."""
+    rel_paths = git_list_files(root, use_gitignore)
+    if rel_paths is None:
+        return None
+    return filter_git_paths(root, rel_paths, matcher)
+
+def git_changed_files(
+    root: Path, pathspec: List[str], since: Optional[str], staged: bool
+) -> List[str]:
+    """Возвращает изменённые файлы (относительно root) по git diff."""
+    cmd = ["git", "diff", "--name-only", "-z", "--relative", "--diff-filter=ACMR"]
+    if staged:
+        cmd.append("--cached")
+    if since:
+        cmd.append(since)
+    commands = [cmd + ["--", *pathspec]]
+    if since and not staged:
+        commands.append(["git", "ls-files", "-z", "--others", "--exclude-standard", "--", *pathspec])
+    changed: List[str] = []
+    for command in commands:
+        try:
+            proc = subprocess.run(command, cwd=root, capture_output=True, check=False)
+        except OSError as e:
+            raise RuntimeError(f"не удалось запустить git: {e}") from e
+        if proc.returncode != 0:
+            message = os.fsdecode(proc.stderr).strip()
+            raise RuntimeError(message or f"git завершился с кодом {proc.returncode}")
+        changed.extend(p for p in os.fsdecode(proc.stdout).split("\0") if p)
+    return changed
+
+def discover_changed_files(
+    paths: List[Path],
+    since: Optional[str],
+    staged: bool,
+    excludes: Optional[List[str]] = None,
+) -> Dict[str, List[Path]]:
+    """Находит исходные файлы, изменённые относительно ревизии или проиндексированные.
+
+    Возбуждает RuntimeError, если git недоступен или путь вне рабочей копии.
+    """
     discovered: Dict[str, List[Path]] = {
-        "py": [], "sh": [], "html": [], "css": [], "js": []
-    }
-    supported_suffixes = {
-        ".py": "py", ".sh": "sh", ".html": "html",
-        ".css": "css", ".js": "js",
+        file_type: [] for file_type in SUPPORTED_SUFFIXES.values()
     }
-
     for root_path in paths:
-        if root_path.is_file():
-            if root_path.suffix in supported_suffixes:
-                file_type = supported_suffixes[root_path.suffix]
-                discovered[file_type].append(root_path)
-            continue
         if not root_path.exists():
             continue
-        for dirpath, dirnames, filenames in os.walk(root_path):
-
-            dirnames[:] = [
-                d for d in dirnames if d not in SAFE_EXCLUDED_DIRNAMES and not d.startswith(".")
-            ]
-            for filename in filenames:
-                file_path = Path(dirpath) / filename
-                if file_path.suffix in supported_suffixes:
-                    file_type = supported_suffixes[file_path.suffix]
-                    discovered[file_type].append(file_path)
+        if root_path.is_file():
+            root, pathspec, matcher = root_path.parent, [root_path.name], None
+        else:
+            root, pathspec = root_path, []
+            matcher, _ = build_root_matcher(root_path, excludes or [], False)
+        if find_git_toplevel(root) is None:
+            raise RuntimeError(f"{root} не находится в рабочей копии git")
+        rel_paths = git_changed_files(root, pathspec, since, staged)
+        for file_path, file_type in filter_git_paths(root, rel_paths, matcher):
+            discovered[file_type].append(Path(file_path))
+    return discovered
+
+def discover_source_files(
+    paths: List[Path],
+    workers: Optional[int] = None,
+    excludes: Optional[List[str]] = None,
+    use_gitignore: bool = True,
+    backend: str = "auto",
+) -> Dict[str, List[Path]]:
+    """Находит исходные файлы (.py, .sh, .html, .css, .js) в указанных путях.
+
+    backend: "git" — через git ls-files, "walk" — обход файловой системы,
+    "auto" — git внутри рабочей копии (если учитывается .gitignore), иначе обход.
+    """
+    discovered: Dict[str, List[Path]] = {
+        file_type: [] for file_type in SUPPORTED_SUFFIXES.values()
+    }
+
+    with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+        for root_path in paths:
+            if root_path.is_file():
+                if root_path.suffix in SUPPORTED_SUFFIXES:
+                    file_type = SUPPORTED_SUFFIXES[root_path.suffix]
+                    discovered[file_type].append(root_path)
+                continue
+            if not root_path.exists():
+                continue
+            found = None
+            use_git = backend == "git" or (backend == "auto" and use_gitignore)
+            if use_git and find_git_toplevel(root_path) is not None:
+                exclude_matcher, _ = build_root_matcher(root_path, excludes or [], False)
+                found = list_source_tree_git(root_path, exclude_matcher, use_gitignore)
+            if found is None:
+                matcher, rel_root = build_root_matcher(root_path, excludes or [], use_gitignore)
+                found = walk_source_tree(str(root_path), pool, rel_root, matcher, use_gitignore)
+            for file_path, file_type in found:
+                discovered[file_type].append(Path(file_path))
     return discovered
 
 def has_shebang(line: str) -> bool:
@@ -62,42 +452,227 @@ def has_encoding_cookie(line: str) -> bool:
     """Проверяет, содержит ли строка кодировку (PEP 263)."""
     return ENCODING_COOKIE_RE.search(line) is not None
 
-def should_keep_py_comment(comment_text: str, keep_keywords: Set[str]) -> bool:
+KeepRules = Union[AbstractSet[str], "re.Pattern[str]"]
+
+NEVER_MATCH_RE = re.compile(r"(?!)")
+
+def parse_keep_keywords(value: str) -> FrozenSet[str]:
+    """Разбирает список ключевых слов из командной строки (через запятую)."""
+    return frozenset(kw.strip() for kw in value.split(",") if kw.strip())
+
+@lru_cache(maxsize=None)
+def compile_keep_matcher(keywords: FrozenSet[str]) -> "re.Pattern[str]":
+    """Собирает ключевые слова в одно регулярное выражение (без учёта регистра).
+
+    "слово" — подстрока в любом месте комментария, "^слово" — только в начале
+    текста комментария (после #), "re:шаблон" — произвольное регулярное выражение.
+    """
+    alternatives: List[str] = []
+    for keyword in sorted(keywords):
+        if keyword.startswith("re:"):
+            alternatives.append(f"(?:{keyword[3:]})")
+        elif keyword.startswith("^"):
+            alternatives.append(r"\A" + re.escape(keyword[1:]))
+        else:
+            alternatives.append(re.escape(keyword))
+    if not alternatives:
+        return NEVER_MATCH_RE
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+def as_keep_matcher(keep_keywords: KeepRules) -> "re.Pattern[str]":
+    """Приводит набор ключевых слов к скомпилированному матчеру (с кешированием)."""
+    if isinstance(keep_keywords, re.Pattern):
+        return keep_keywords
+    return compile_keep_matcher(frozenset(keep_keywords))
+
+def should_keep_comment(comment_text: str, keep_keywords: KeepRules) -> bool:
+    """Проверяет текст комментария (без ведущих # и пробелов) по правилам сохранения."""
+    body = comment_text.lstrip().lstrip("#").lstrip()
+    return as_keep_matcher(keep_keywords).search(body) is not None
+
+def should_keep_py_comment(comment_text: str, keep_keywords: KeepRules) -> bool:
     """Определяет, следует ли сохранить комментарий в Python коде."""
-    lower = comment_text.lower()
-    return any(kw in lower for kw in keep_keywords)
+    return should_keep_comment(comment_text, keep_keywords)
 
-def should_keep_sh_comment(comment_line: str, keep_keywords: Set[str]) -> bool:
+def should_keep_sh_comment(comment_line: str, keep_keywords: KeepRules) -> bool:
     """Определяет, следует ли сохранить комментарий в Shell скрипте."""
-    text_part = comment_line.lstrip()[1:].lstrip()
-    lower = text_part.lower()
-    return any(kw in lower for kw in keep_keywords)
+    return should_keep_comment(comment_line, keep_keywords)
+
+INDENT_POLICIES = ("keep", "spaces", "tabs")
+FINAL_NEWLINE_POLICIES = ("ensure", "keep", "strip")
+NEWLINE_POLICIES = ("preserve", "lf", "crlf")
+
+class WhitespacePolicy(NamedTuple):
+    """Политика пробелов: отступы, ширина табуляции, последний перевод строки, переводы строк."""
+
+    indent: str = "keep"
+    tab_size: int = 4
+    final_newline: str = "ensure"
+    newline: str = "preserve"
+
+    def rewrites_text(self) -> bool:
+        """Нужна ли правка текста сверх обычной чистки пробелов (отступы или final_newline)."""
+        return self.indent != "keep" or self.final_newline != "ensure"
+
+DEFAULT_WHITESPACE_POLICY = WhitespacePolicy()
+
+def reindent(line: str, indent: str, tab_size: int) -> str:
+    """Переводит ведущий отступ строки в пробелы или табуляции."""
+    body = line.lstrip(" \t")
+    lead = line[:len(line) - len(body)]
+    if not lead or (indent == "spaces" and "\t" not in lead):
+        return line
+    width = len(lead.expandtabs(tab_size))
+    if indent == "spaces":
+        return " " * width + body
+    return "\t" * (width // tab_size) + " " * (width % tab_size) + body
+
+Span = Tuple[int, int]
+
+def normalize_whitespace(
+    text: str,
+    indent: str = "keep",
+    tab_size: int = 4,
+    final_newline: str = "ensure",
+    max_newlines: int = 2,
+    protected: Sequence[Span] = (),
+) -> Tuple[str, int, int]:
+    """Нормализует пробелы за один проход по строкам.
+
+    Убирает пробелы в конце строк, оставляет не более max_newlines переводов строки подряд,
+    переводит отступы (indent: keep/spaces/tabs) и применяет final_newline (ensure/strip).
+    protected — отсортированные непересекающиеся диапазоны [start, end) символов (строковые
+    литералы, <pre>), пробелы и переводы строк внутри которых не меняются.
+    Возвращает текст, число изменённых или удалённых строк и изменение размера в байтах
+    (пробельные символы однобайтовые); без изменений возвращается исходный объект.
+    """
+    parts: List[str] = []
+    changed_lines = 0
+    newline_run = 0
+    pos = 0
+    size = len(text)
+    span_index = 0
+    span_count = len(protected)
+
+    def covered(start: int, stop: int) -> bool:
+        index = span_index
+        while index < span_count and protected[index][0] < stop:
+            if protected[index][1] > start:
+                return True
+            index += 1
+        return False
+
+    while pos < size:
+        end = text.find("\n", pos)
+        if end < 0:
+            end = size
+        line = text[pos:end]
+        stripped = line.rstrip(" \t")
+        if span_count:
+            while span_index < span_count and protected[span_index][1] <= pos:
+                span_index += 1
+            if covered(pos + len(stripped), end + 1):
+                stripped = line
+        if indent != "keep" and stripped:
+            lead = len(stripped) - len(stripped.lstrip(" \t"))
+            if not (span_count and lead and covered(pos, pos + lead)):
+                stripped = reindent(stripped, indent, tab_size)
+        if stripped or (span_count and covered(end, end + 1)):
+            newline_run = 0
+            if stripped:
+                parts.append(stripped)
+        elif end < size and newline_run >= max_newlines:
+            changed_lines += 1
+            pos = end + 1
+            continue
+        if stripped != line:
+            changed_lines += 1
+        if end < size:
+            parts.append("\n")
+            newline_run += 1
+        pos = end + 1
+    if final_newline == "ensure":
+        if parts and parts[-1] != "\n":
+            parts.append("\n")
+            changed_lines += 1
+    elif final_newline == "strip":
+        while parts and parts[-1] == "\n":
+            parts.pop()
+            changed_lines += 1
+    if not changed_lines:
+        return text, 0, 0
+    result = "".join(parts)
+    return result, changed_lines, len(result) - size
 
 def cleanup_empty_lines(text: str) -> str:
     """Убирает лишние пустые строки, оставляя не более одной подряд."""
-    text = re.sub(r"[ \t]+$", "", text, flags=re.MULTILINE)
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    if not text.endswith("\n") and text:
-        text += "\n"
-    return text
+    return normalize_whitespace(text)[0]
 
-def strip_python_comments(source: str, keep_keywords: Set[str]) -> str:
-    """Удаляет ненужные комментарии из Python кода."""
-    lines = source.splitlines(keepends=True)
-    preserved_prefix: List[str] = []
-    remaining_start_index = 0
+class WhitespaceNormalizer:
+    """Потоковый вариант cleanup_empty_lines: состояние строки переносится между частями.
+
+    Держит в памяти только хвостовые пробелы текущей строки, а не саму строку.
+    Фрагменты с raw=True (тела <pre>/<textarea>) передаются без изменений.
+    """
+
+    def __init__(self, max_newlines: int = 2):
+        self.max_newlines = max_newlines
+        self.newline_run = 0
+        self.blanks = ""
+        self.last = ""
+
+    def feed(self, text: str, raw: bool = False) -> str:
+        """Нормализует очередную часть текста и возвращает готовый фрагмент."""
+        if not text:
+            return ""
+        parts: List[str] = []
+        if raw:
+            parts.extend((self.blanks, text))
+            self.blanks = ""
+            self.newline_run = 0
+        else:
+            pos = 0
+            size = len(text)
+            while pos < size:
+                end = text.find("\n", pos)
+                if end < 0:
+                    end = size
+                segment = text[pos:end]
+                stripped = segment.rstrip(" \t")
+                if stripped:
+                    parts.extend((self.blanks, stripped))
+                    self.blanks = segment[len(stripped):]
+                    self.newline_run = 0
+                else:
+                    self.blanks += segment
+                if end < size:
+                    self.blanks = ""
+                    if self.newline_run < self.max_newlines:
+                        parts.append("\n")
+                        self.newline_run += 1
+                pos = end + 1
+        result = "".join(parts)
+        if result:
+            self.last = result[-1]
+        return result
+
+    def finish(self) -> str:
+        """Отбрасывает хвостовые пробелы и завершает вывод переводом строки."""
+        self.blanks = ""
+        if self.last and self.last != "\n":
+            self.last = "\n"
+            return "\n"
+        return ""
 
-    if lines and has_shebang(lines[0]):
-        preserved_prefix.append(lines[0])
-        remaining_start_index = 1
-    if remaining_start_index < len(lines) and has_encoding_cookie(lines[remaining_start_index]):
-        preserved_prefix.append(lines[remaining_start_index])
-        remaining_start_index += 1
+def strip_python_comments_untokenize(source: str, keep_keywords: KeepRules) -> str:
+    """Удаляет комментарии через полный список токенов и tokenize.untokenize."""
+    prefix_end = 0
+    for _ in preserved_prefix_rows(source):
+        prefix_end = source.find("\n", prefix_end) + 1 or len(source)
 
-    remaining = "".join(lines[remaining_start_index:])
     tokens: List[tokenize.TokenInfo] = []
     try:
-        tok_iter = tokenize.tokenize(io.BytesIO(remaining.encode("utf-8")).readline)
+        tok_iter = tokenize.generate_tokens(io.StringIO(source[prefix_end:]).readline)
         for tok in tok_iter:
             if tok.type == tokenize.COMMENT:
                 if should_keep_py_comment(tok.string, keep_keywords):
@@ -108,14 +683,73 @@ def strip_python_comments(source: str, keep_keywords: Set[str]) -> str:
         return source
 
     try:
-        processed = tokenize.untokenize(tokens)
-        processed_text = processed.decode("utf-8") if isinstance(processed, bytes) else processed
+        processed_text = tokenize.untokenize(tokens)
     except Exception:
         return source
 
-    return "".join(preserved_prefix) + cleanup_empty_lines(processed_text)
+    return source[:prefix_end] + cleanup_empty_lines(processed_text)
+
+def preserved_prefix_rows(source: str) -> Set[int]:
+    """Возвращает номера строк shebang/PEP 263, которые нельзя трогать."""
+    first_end = source.find("\n") + 1 or len(source)
+    second_end = source.find("\n", first_end) + 1 or len(source)
+    lines = [source[:first_end], source[first_end:second_end]]
+    rows: Set[int] = set()
+    index = 0
+    if has_shebang(lines[0]):
+        rows.add(1)
+        index = 1
+    if has_encoding_cookie(lines[index]):
+        rows.add(index + 1)
+    return rows
+
+def strip_python_comments_splice(source: str, keep_keywords: KeepRules) -> str:
+    """Вырезает комментарии по смещениям токенов, не пересобирая исходный код."""
+    protected_rows = preserved_prefix_rows(source)
+    parts: List[str] = []
+    pos = 0
+    row = 1
+    row_offset = 0
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+            if tok.type != tokenize.COMMENT:
+                continue
+            (start_row, start_col), (_, end_col) = tok.start, tok.end
+            if start_row in protected_rows or should_keep_py_comment(tok.string, keep_keywords):
+                continue
+            while row < start_row:
+                row_offset = source.index("\n", row_offset) + 1
+                row += 1
+            start = row_offset + start_col
+            end = row_offset + end_col
+            if not source[row_offset:start].strip():
+                start = row_offset
+                newline = source.find("\n", end)
+                end = len(source) if newline < 0 else newline + 1
+            else:
+                while start > row_offset and source[start - 1] in " \t":
+                    start -= 1
+            parts.append(source[pos:start])
+            pos = end
+    except (tokenize.TokenError, SyntaxError):
+        return source
+    if not parts:
+        return cleanup_empty_lines(source)
+    parts.append(source[pos:])
+    return cleanup_empty_lines("".join(parts))
+
+PY_COMMENT_ENGINES: Dict[str, Callable[[str, KeepRules], str]] = {
+    "splice": strip_python_comments_splice,
+    "untokenize": strip_python_comments_untokenize,
+}
+
+def strip_python_comments(
+    source: str, keep_keywords: KeepRules, engine: str = "splice"
+) -> str:
+    """Удаляет ненужные комментарии из Python кода."""
+    return PY_COMMENT_ENGINES[engine](source, keep_keywords)
 
-def strip_shell_comments(source: str, keep_keywords: Set[str]) -> str:
+def strip_shell_comments(source: str, keep_keywords: KeepRules) -> str:
     """Удаляет ненужные комментарии из Shell скрипта."""
     lines = source.splitlines(keepends=True)
     if not lines:
@@ -134,37 +768,1258 @@ def strip_shell_comments(source: str, keep_keywords: Set[str]) -> str:
             new_lines.append(line)
     return cleanup_empty_lines("".join(new_lines))
 
-def strip_html_comments(source: str) -> str:
-    """Удаляет комментарии <!-- ... --> из HTML кода."""
-    cleaned = re.sub(r"<!--.*?-->", "", source, flags=re.DOTALL)
-    return cleanup_empty_lines(cleaned)
+JS_REGEX_PRECEDERS = frozenset("(,=:[!&|?{};+-*%<>~^")
+JS_REGEX_KEYWORDS = frozenset({
+    "return", "typeof", "case", "do", "else", "in", "instanceof", "new",
+    "delete", "void", "throw", "yield", "await",
+})
+GAP_SAFE_CHARS = frozenset("(){}[],;:")
+CSS_TIGHT_CHARS = frozenset("{};,>")
+WORD_TAIL_RE = re.compile(r"[A-Za-z0-9_$]+$")
+WHITESPACE_SPLIT_RE = re.compile(r"(\s+)")
 
-def strip_css_comments(source: str) -> str:
-    """Удаляет комментарии /* ... */ из CSS кода."""
-    cleaned = re.sub(r"/\*.*?\*/", "", source, flags=re.DOTALL)
-    return cleanup_empty_lines(cleaned)
+def is_js_word_char(char: str) -> bool:
+    """Проверяет, может ли символ входить в идентификатор или число JavaScript."""
+    return char.isalnum() or char in "_$\\" or ord(char) > 127
+
+class WebCommentLexer:
+    """Потоковый лексер CSS/JS: удаляет комментарии, не трогая строки, шаблоны и регулярные выражения.
+
+    Состояние сохраняется между вызовами feed(), поэтому вход можно подавать частями:
+    памяти нужно O(размер части), время линейно от длины входа.
+    С minify=True пробелы в коде сжимаются там, где они не разделяют токены.
+    """
+
+    CODE, SINGLE, DOUBLE, TEMPLATE, REGEX, REGEX_CLASS, LINE_COMMENT, BLOCK_COMMENT = range(8)
+
+    CSS_SPECIAL_RE = re.compile(r"[/'\"]")
+    JS_SPECIAL_RE = re.compile(r"[/'\"`{}]")
+    SINGLE_RE = re.compile(r"['\\\n]")
+    DOUBLE_RE = re.compile(r"[\"\\\n]")
+    TEMPLATE_RE = re.compile(r"[`\\$]")
+    REGEX_RE = re.compile(r"[/\\\[\n]")
+    REGEX_CLASS_RE = re.compile(r"[\]\\\n]")
+
+    def __init__(self, language: str, minify: bool = False):
+        self.js = language == "js"
+        self.minify = minify
+        self.special = self.JS_SPECIAL_RE if self.js else self.CSS_SPECIAL_RE
+        self.state = self.CODE
+        self.pending = ""
+        self.templates: List[int] = []
+        self.last_sig = ""
+        self.last_word = ""
+        self.sign_run = 0
+        self.last_out = ""
+        self.gap = False
+        self.space = ""
+        self.out: List[str] = []
+        self.handlers = {
+            self.CODE: self._code,
+            self.SINGLE: partial(self._quoted, self.SINGLE_RE),
+            self.DOUBLE: partial(self._quoted, self.DOUBLE_RE),
+            self.TEMPLATE: self._template,
+            self.REGEX: self._regex,
+            self.REGEX_CLASS: self._regex_class,
+            self.LINE_COMMENT: self._line_comment,
+            self.BLOCK_COMMENT: self._block_comment,
+        }
+
+    def feed(self, chunk: str) -> str:
+        """Обрабатывает очередную часть входа и возвращает готовый фрагмент вывода."""
+        return self._run(self.pending + chunk, final=False)
+
+    def finish(self) -> str:
+        """Дообрабатывает отложенный хвост входа."""
+        return self._run(self.pending, final=True)
+
+    def _run(self, buf: str, final: bool) -> str:
+        limit = len(buf) if final else len(buf) - 1
+        i = 0
+        while i < limit:
+            i = self.handlers[self.state](buf, i, limit)
+        self.pending = buf[i:] if not final else ""
+        result = "".join(self.out)
+        self.out.clear()
+        return result
+
+    def _emit(self, text: str) -> None:
+        if not text:
+            return
+        if self.gap:
+            self.gap = False
+            before, after = self.last_out, text[0]
+            if (before and not before.isspace() and not after.isspace()
+                    and before not in GAP_SAFE_CHARS and after not in GAP_SAFE_CHARS):
+                self.out.append(" ")
+        if self.space:
+            if self.last_out and self._needs_space(self.last_out, text[0]):
+                self.out.append(self.space)
+            self.space = ""
+        self.out.append(text)
+        self.last_out = text[-1]
+
+    def _emit_code(self, text: str) -> None:
+        stripped = text.rstrip()
+        if stripped:
+            tail = WORD_TAIL_RE.search(stripped)
+            if tail is None:
+                self.last_word = ""
+            elif (tail.start() == 0 and not self.space and self.last_sig == self.last_out
+                    and WORD_TAIL_RE.match(self.last_out)):
+                self.last_word += tail.group()
+            else:
+                self.last_word = tail.group()
+            sig = stripped[-1]
+            run = len(stripped) - len(stripped.rstrip(sig)) if sig in "+-" else 0
+            if (run == len(stripped) and sig == self.last_sig == self.last_out
+                    and not self.space and not self.gap):
+                run += self.sign_run
+            self.sign_run = run
+            self.last_sig = sig
+        if not self.minify:
+            self._emit(text)
+            return
+        for index, piece in enumerate(WHITESPACE_SPLIT_RE.split(text)):
+            if index % 2 == 0:
+                self._emit(piece)
+            elif self.js and ("\n" in piece or self.space == "\n"):
+                self.space = "\n"
+            else:
+                self.space = " "
+
+    def _needs_space(self, before: str, after: str) -> bool:
+        if not self.js:
+            return before not in CSS_TIGHT_CHARS and after not in CSS_TIGHT_CHARS
+        if self.space == "\n":
+            return True
+        return ((is_js_word_char(before) and is_js_word_char(after))
+                or (before in "+-" and after in "+-")
+                or (before == "/" and after in "/*")
+                or (before.isdigit() and after == "."))
+
+    def _regex_allowed(self) -> bool:
+        sig = self.last_sig
+        if not sig:
+            return True
+        if sig.isalnum() or sig in "_$":
+            return self.last_word in JS_REGEX_KEYWORDS
+        if sig in "+-" and self.sign_run % 2 == 0:
+            return False
+        return sig in JS_REGEX_PRECEDERS
+
+    def _code(self, buf: str, i: int, limit: int) -> int:
+        match = self.special.search(buf, i, limit)
+        if match is None:
+            self._emit_code(buf[i:limit])
+            return limit
+        j = match.start()
+        if j > i:
+            self._emit_code(buf[i:j])
+        char = buf[j]
+        following = buf[j + 1:j + 2]
+        if char == "/":
+            if following == "*":
+                self.state = self.BLOCK_COMMENT
+                return j + 2
+            if self.js and following == "/":
+                self.state = self.LINE_COMMENT
+                return j + 2
+            if self.js and self._regex_allowed():
+                self._emit(char)
+                self.state = self.REGEX
+                return j + 1
+            self._emit_code(char)
+            return j + 1
+        if char == "'" or char == '"':
+            self._emit(char)
+            self.state = self.SINGLE if char == "'" else self.DOUBLE
+            return j + 1
+        if char == "`":
+            self._emit(char)
+            self.state = self.TEMPLATE
+            return j + 1
+        if self.templates:
+            if char == "{":
+                self.templates[-1] += 1
+            elif self.templates[-1] == 0:
+                self.templates.pop()
+                self._emit(char)
+                self.state = self.TEMPLATE
+                return j + 1
+            else:
+                self.templates[-1] -= 1
+        self._emit_code(char)
+        return j + 1
+
+    def _quoted(self, pattern: "re.Pattern[str]", buf: str, i: int, limit: int) -> int:
+        match = pattern.search(buf, i, limit)
+        if match is None:
+            self._emit(buf[i:limit])
+            return limit
+        j = match.start()
+        if buf[j] == "\\":
+            self._emit(buf[i:j + 2])
+            return j + 2
+        self._emit(buf[i:j + 1])
+        self.state = self.CODE
+        self.last_sig, self.last_word = buf[j], ""
+        return j + 1
+
+    def _template(self, buf: str, i: int, limit: int) -> int:
+        match = self.TEMPLATE_RE.search(buf, i, limit)
+        if match is None:
+            self._emit(buf[i:limit])
+            return limit
+        j = match.start()
+        char = buf[j]
+        if char == "\\":
+            self._emit(buf[i:j + 2])
+            return j + 2
+        if char == "`":
+            self._emit(buf[i:j + 1])
+            self.state = self.CODE
+            self.last_sig, self.last_word = char, ""
+            return j + 1
+        if buf[j + 1:j + 2] == "{":
+            self._emit(buf[i:j + 2])
+            self.templates.append(0)
+            self.state = self.CODE
+            self.last_sig, self.last_word = "{", ""
+            return j + 2
+        self._emit(buf[i:j + 1])
+        return j + 1
+
+    def _regex(self, buf: str, i: int, limit: int) -> int:
+        match = self.REGEX_RE.search(buf, i, limit)
+        if match is None:
+            self._emit(buf[i:limit])
+            return limit
+        j = match.start()
+        char = buf[j]
+        if char == "\\":
+            self._emit(buf[i:j + 2])
+            return j + 2
+        self._emit(buf[i:j + 1])
+        if char == "[":
+            self.state = self.REGEX_CLASS
+        else:
+            self.state = self.CODE
+            self.last_sig, self.last_word = ")", ""
+        return j + 1
+
+    def _regex_class(self, buf: str, i: int, limit: int) -> int:
+        match = self.REGEX_CLASS_RE.search(buf, i, limit)
+        if match is None:
+            self._emit(buf[i:limit])
+            return limit
+        j = match.start()
+        char = buf[j]
+        if char == "\\":
+            self._emit(buf[i:j + 2])
+            return j + 2
+        self._emit(buf[i:j + 1])
+        self.state = self.REGEX if char == "]" else self.CODE
+        return j + 1
+
+    def _line_comment(self, buf: str, i: int, limit: int) -> int:
+        end = buf.find("\n", i, limit)
+        if end < 0:
+            return limit
+        self.state = self.CODE
+        return end
+
+    def _block_comment(self, buf: str, i: int, limit: int) -> int:
+        end = buf.find("*/", i)
+        if end < 0:
+            return limit
+        self.state = self.CODE
+        if self.minify:
+            self.space = self.space or " "
+        else:
+            self.gap = True
+        return end + 2
+
+def strip_web_comments(source: str, language: str, minify: bool = False) -> str:
+    """Удаляет комментарии из CSS/JS кода потоковым лексером."""
+    lexer = WebCommentLexer(language, minify)
+    return lexer.feed(source) + lexer.finish()
 
-def strip_js_comments(source: str) -> str:
-    """Удаляет комментарии /* ... */ и // ... из JavaScript кода."""
+def strip_css_comments_regex(source: str) -> str:
+    """Удаляет комментарии /* ... */ из CSS кода регулярным выражением."""
+    return re.sub(r"/\*.*?\*/", "", source, flags=re.DOTALL)
 
+def strip_js_comments_regex(source: str) -> str:
+    """Удаляет комментарии /* ... */ и // ... из JavaScript кода регулярными выражениями."""
     cleaned = re.sub(r"/\*.*?\*/", "", source, flags=re.DOTALL)
+    return re.sub(r"(?<!:)//.*", "", cleaned)
+
+WEB_COMMENT_ENGINES: Dict[str, Dict[str, Callable[[str], str]]] = {
+    "lexer": {
+        "css": partial(strip_web_comments, language="css"),
+        "js": partial(strip_web_comments, language="js"),
+    },
+    "regex": {
+        "css": strip_css_comments_regex,
+        "js": strip_js_comments_regex,
+    },
+}
+
+HTML_JS_TYPES = frozenset({
+    "", "module", "text/javascript", "application/javascript",
+    "text/ecmascript", "application/ecmascript",
+})
+HTML_CSS_TYPES = frozenset({"", "text/css"})
+HTML_TYPE_ATTR_RE = re.compile(r"""\stype\s*=\s*(["']?)([^"'\s>]*)\1""", re.IGNORECASE)
+HTML_TEXT_WHITESPACE_RE = re.compile(r"(<[^>]*>)|\s+")
+HTML_RAW_BLOCK_RE = re.compile(r"(<(pre|textarea)\b.*?</\2\s*>)", re.IGNORECASE | re.DOTALL)
+
+class HtmlCommentStripper:
+    """Потоковый обработчик HTML: удаляет <!-- --> и чистит встроенные <script>/<style>.
+
+    Содержимое <pre>, <textarea> и условные комментарии копируются как есть.
+    Документ проходится один раз; тела скриптов и стилей уходят в WebCommentLexer по мере чтения.
+    С minify=True пробелы между тегами и в тексте сжимаются, а скрипты и стили минифицируются.
+    С normalizer вывод сразу проходит потоковую чистку пробелов (тела <pre>/<textarea> — как есть).
+    """
+
+    TEXT, COMMENT, RAW = range(3)
+
+    OPEN_RE = re.compile(r"<!--|<(script|style|pre|textarea)\b", re.IGNORECASE)
+    TAG_RE = re.compile(r"""<[a-zA-Z]+(?:[^>"']|"[^"]*"|'[^']*')*>""")
+    CLOSE_RE = {
+        name: re.compile(f"</{name}", re.IGNORECASE)
+        for name in ("script", "style", "pre", "textarea")
+    }
+    CONDITIONAL_PREFIXES = ("<!--[if", "<!--<![endif]", "<!--[endif]")
+    CONDITIONAL_LOOKAHEAD = max(map(len, CONDITIONAL_PREFIXES))
+    HOLD = len("<textarea")
+
+    def __init__(self, minify: bool = False, normalizer: Optional["WhitespaceNormalizer"] = None) -> None:
+        self.minify = minify
+        self.normalizer = normalizer
+        self.protected = False
+        self.state = self.TEXT
+        self.pending = ""
+        self.keep_comment = False
+        self.close_re: Optional["re.Pattern[str]"] = None
+        self.lexer: Optional[WebCommentLexer] = None
+        self.out: List[str] = []
+
+    def feed(self, chunk: str) -> str:
+        """Обрабатывает очередную часть документа и возвращает готовый фрагмент вывода."""
+        return self._run(self.pending + chunk, final=False)
+
+    def finish(self) -> str:
+        """Дообрабатывает отложенный хвост документа."""
+        return self._run(self.pending, final=True)
+
+    def _run(self, buf: str, final: bool) -> str:
+        i = 0
+        while True:
+            if self.state == self.TEXT:
+                advanced = self._text(buf, i, final)
+            elif self.state == self.COMMENT:
+                advanced = self._comment(buf, i, final)
+            else:
+                advanced = self._raw(buf, i, final)
+            if advanced == i:
+                break
+            i = advanced
+        self.pending = "" if final else buf[i:]
+        result = "".join(self.out)
+        self.out.clear()
+        return result
+
+    def _text(self, buf: str, i: int, final: bool) -> int:
+        match = self.OPEN_RE.search(buf, i)
+        if match is None:
+            end = len(buf) if final else max(i, len(buf) - self.HOLD)
+            if self.minify and not final:
+                tag_start = buf.rfind("<", i, end)
+                if tag_start >= 0 and buf.find(">", tag_start, end) < 0:
+                    end = tag_start
+                while end > i and buf[end - 1].isspace():
+                    end -= 1
+            self._emit_text(buf[i:end])
+            return end
+        start = match.start()
+        self._emit_text(buf[i:start])
+        name = match.group(1)
+        if name is None:
+            head = buf[start:start + self.CONDITIONAL_LOOKAHEAD]
+            if len(head) < self.CONDITIONAL_LOOKAHEAD and not final:
+                return start
+            self.keep_comment = head.startswith(self.CONDITIONAL_PREFIXES)
+            if self.keep_comment:
+                self._out(buf[start:match.end()])
+            self.state = self.COMMENT
+            return match.end()
+        tag = self.TAG_RE.match(buf, start)
+        if tag is None:
+            if not final and ">" not in buf[start:]:
+                return start
+            self._out(buf[start:match.end()])
+            return match.end()
+        self._out(tag.group())
+        name = name.lower()
+        self.close_re = self.CLOSE_RE[name]
+        self.protected = name in ("pre", "textarea")
+        self.lexer = None
+        if name in ("script", "style"):
+            type_attr = HTML_TYPE_ATTR_RE.search(tag.group())
+            mime = type_attr.group(2).lower() if type_attr else ""
+            if name == "script" and mime in HTML_JS_TYPES:
+                self.lexer = WebCommentLexer("js", self.minify)
+            elif name == "style" and mime in HTML_CSS_TYPES:
+                self.lexer = WebCommentLexer("css", self.minify)
+        self.state = self.RAW
+        return tag.end()
+
+    def _out(self, text: str, raw: bool = False) -> None:
+        if self.normalizer is not None:
+            text = self.normalizer.feed(text, raw)
+        self.out.append(text)
+
+    def _emit_text(self, text: str) -> None:
+        if self.minify:
+            text = HTML_TEXT_WHITESPACE_RE.sub(collapse_html_whitespace, text)
+        self._out(text)
+
+    def _comment(self, buf: str, i: int, final: bool) -> int:
+        end = buf.find("-->", i)
+        if end < 0:
+            stop = len(buf) if final else max(i, len(buf) - 2)
+            if self.keep_comment:
+                self._out(buf[i:stop])
+            return stop
+        if self.keep_comment:
+            self._out(buf[i:end + 3])
+        self.state = self.TEXT
+        return end + 3
+
+    def _raw(self, buf: str, i: int, final: bool) -> int:
+        assert self.close_re is not None
+        match = self.close_re.search(buf, i)
+        if match is None:
+            end = len(buf) if final else max(i, len(buf) - self.HOLD)
+            body = buf[i:end]
+            if self.lexer is not None:
+                body = self.lexer.feed(body)
+                if final:
+                    body += self.lexer.finish()
+            self._out(body, self.protected)
+            return end
+        body = buf[i:match.start()]
+        if self.lexer is not None:
+            body = self.lexer.feed(body) + self.lexer.finish()
+        self._out(body, self.protected)
+        self._out(buf[match.start():match.end()])
+        self.state = self.TEXT
+        return match.end()
+
+def collapse_html_whitespace(match: "re.Match[str]") -> str:
+    """Сжимает пробельную последовательность вне тегов до одного символа."""
+    if match.group(1) is not None:
+        return match.group(1)
+    return "\n" if "\n" in match.group() else " "
+
+def cleanup_html_whitespace(text: str) -> str:
+    """Чистит пустые строки в HTML, не трогая содержимое <pre> и <textarea>."""
+    parts = HTML_RAW_BLOCK_RE.split(text)
+    cleaned: List[str] = []
+    for index in range(0, len(parts), 3):
+        segment = re.sub(r"[ \t]+(?=\n)", "", parts[index])
+        cleaned.append(re.sub(r"\n{3,}", "\n\n", segment))
+        if index + 1 < len(parts):
+            cleaned.append(parts[index + 1])
+    result = "".join(cleaned).rstrip(" \t")
+    if result and not result.endswith("\n"):
+        result += "\n"
+    return result
+
+def strip_html_comments(source: str, minify: bool = False) -> str:
+    """Удаляет комментарии <!-- ... --> из HTML кода и чистит встроенные скрипты и стили."""
+    stripper = HtmlCommentStripper(minify)
+    return cleanup_html_whitespace(stripper.feed(source) + stripper.finish())
+
+def strip_css_comments(source: str, engine: str = "lexer", minify: bool = False) -> str:
+    """Удаляет комментарии /* ... */ из CSS кода (minify всегда использует лексер)."""
+    if minify:
+        return cleanup_empty_lines(strip_web_comments(source, "css", minify=True))
+    return cleanup_empty_lines(WEB_COMMENT_ENGINES[engine]["css"](source))
+
+def strip_js_comments(source: str, engine: str = "lexer", minify: bool = False) -> str:
+    """Удаляет комментарии /* ... */ и // ... из JavaScript кода (minify всегда использует лексер)."""
+    if minify:
+        return cleanup_empty_lines(strip_web_comments(source, "js", minify=True))
+    return cleanup_empty_lines(WEB_COMMENT_ENGINES[engine]["js"](source))
 
-    cleaned = re.sub(r"(?<!:)//.*", "", cleaned)
-    return cleanup_empty_lines(cleaned)
+def strip_nothing(source: str) -> str:
+    """Возвращает исходный код без изменений (обработчик-заглушка)."""
+    return source
 
-def write_if_changed(path: Path, new_content: str, dry_run: bool) -> bool:
-    """Записывает контент, если он изменился."""
+FSYNC_MODES = ("none", "file", "batch")
+
+def fsync_path(path: Path, flags: int = os.O_RDONLY) -> bool:
+    """Сбрасывает на диск данные файла или каталога по пути; ошибки игнорируются."""
     try:
-        old_content = path.read_text(encoding="utf-8")
-    except Exception:
-        old_content = None
-    if old_content == new_content:
+        fd = os.open(str(path), flags)
+    except OSError:
+        return False
+    try:
+        os.fsync(fd)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+def fsync_directory(directory: Path) -> None:
+    """Сбрасывает на диск записи каталога (переименования); ошибки игнорируются."""
+    fsync_path(directory)
+
+def temp_path_for(path: Path) -> Path:
+    """Имя временного файла рядом с целью (уникальное для процесса и потока)."""
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+def discard_temp(tmp: Path) -> None:
+    """Удаляет временный файл, игнорируя ошибки."""
+    try:
+        tmp.unlink()
+    except OSError:
+        pass
+
+def atomic_write_bytes(path: Path, data: bytes, fsync: bool = False) -> None:
+    """Записывает файл через временный файл в том же каталоге и os.replace.
+
+    Права и владелец существующего файла сохраняются, символическая ссылка не заменяется.
+    """
+    if path.is_symlink():
+        path = path.resolve()
+    tmp = temp_path_for(path)
+    try:
+        with open(tmp, "wb") as handle:
+            handle.write(data)
+            if fsync:
+                handle.flush()
+                os.fsync(handle.fileno())
+    except BaseException:
+        discard_temp(tmp)
+        raise
+    replace_with_temp(tmp, path, fsync)
+
+def replace_with_temp(tmp: Path, path: Path, fsync: bool = False) -> None:
+    """Переносит права и владельца цели на временный файл и атомарно заменяет им цель."""
+    try:
+        try:
+            st: Optional[os.stat_result] = path.stat()
+        except FileNotFoundError:
+            st = None
+        if st is not None:
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            if hasattr(os, "chown") and (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+                try:
+                    os.chown(tmp, st.st_uid, st.st_gid)
+                except OSError:
+                    pass
+        os.replace(tmp, path)
+    except BaseException:
+        discard_temp(tmp)
+        raise
+    if fsync:
+        fsync_directory(path.parent)
+
+def sync_written_files(paths: Iterable[Path]) -> int:
+    """Делает fsync каждого записанного файла и по одному fsync на каждый затронутый каталог.
+
+    Глобальный os.sync не используется: он сбрасывает все файловые системы машины.
+    """
+    file_flags = os.O_RDWR if os.name == "nt" else os.O_RDONLY
+    directories: Dict[Path, None] = {}
+    for path in dict.fromkeys(paths):
+        fsync_path(path, file_flags)
+        directories.setdefault(path.parent)
+    for directory in directories:
+        fsync_directory(directory)
+    return len(directories)
+
+class SourceSnapshot(NamedTuple):
+    """Снимок прочитанного файла: хеш байт, stat на момент чтения, кодировка, перевод строки."""
+
+    digest: str
+    stat: os.stat_result
+    encoding: str
+    newline: str
+
+class FileState(NamedTuple):
+    """Состояние файла на диске для StateCache."""
+
+    digest: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def from_stat(cls, digest: str, st: os.stat_result) -> "FileState":
+        """Состояние по хешу содержимого и stat."""
+        return cls(digest, st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def matches(self, st: os.stat_result) -> bool:
+        """Совпадает ли stat файла с запомненным состоянием (без учёта хеша)."""
+        return (self.size, self.mtime_ns, self.inode) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def decode_source(data: Any, encoding: str = "utf-8") -> str:
+    """Декодирует байты (bytes или mmap) с переводом концов строк, как Path.read_text."""
+    text = str(data, encoding)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+def source_encoding(path: Path, data: Any) -> str:
+    """Определяет кодировку файла: для Python — по BOM и PEP 263, иначе UTF-8."""
+    if path.suffix != ".py":
+        return "utf-8"
+    end = data.find(b"\n")
+    if end >= 0:
+        end = data.find(b"\n", end + 1)
+    head = data[:end + 1] if end >= 0 else data[:]
+    return tokenize.detect_encoding(io.BytesIO(head).readline)[0]
+
+def load_source(
+    path: Path, data: Any, st: os.stat_result, markers: Optional[Tuple[bytes, ...]]
+) -> Optional[Tuple[str, SourceSnapshot]]:
+    """Проверяет маркеры по сырым байтам и декодирует файл только при необходимости."""
+    if markers is not None and (st.st_size == 0 or not contains_markers(data, st.st_size, markers)):
+        return None
+    encoding = source_encoding(path, data)
+    newline = "\r\n" if data.find(b"\r\n") >= 0 else "\n"
+    return decode_source(data, encoding), SourceSnapshot(content_hash(data), st, encoding, newline)
+
+def read_source(
+    path: Path, markers: Optional[Tuple[bytes, ...]] = None
+) -> Optional[Tuple[str, SourceSnapshot]]:
+    """Читает файл один раз: текст и снимок (хеш байт, stat на момент чтения, кодировка, перевод строки).
+
+    Большие файлы отображаются через mmap без копирования. Если заданы markers
+    и их нет в файле, он не декодируется и возвращается None.
+    """
+    with open(path, "rb") as handle:
+        st = os.fstat(handle.fileno())
+        if st.st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return load_source(path, data, st, markers)
+        return load_source(path, handle.read(), st, markers)
+
+def snapshot_state(snapshot: SourceSnapshot) -> FileState:
+    """Состояние файла (хеш, размер, mtime, inode) по снимку чтения."""
+    return FileState.from_stat(snapshot.digest, snapshot.stat)
+
+def encode_source(text: str, encoding: str, newline: str = "\n") -> bytes:
+    """Кодирует текст обратно в байты файла с нужным переводом строки."""
+    if newline != "\n":
+        text = text.replace("\n", newline)
+    return text.encode(encoding)
+
+def target_newline(source_newline: str, policy: str) -> str:
+    """Перевод строки для записи: как в исходном файле (preserve), LF или CRLF."""
+    if policy == "preserve":
+        return source_newline
+    return "\r\n" if policy == "crlf" else "\n"
+
+class WhitespaceStats(NamedTuple):
+    """Сколько строк изменила политика пробелов и на сколько байт изменился размер."""
+
+    lines: int = 0
+    delta: int = 0
+
+def python_string_spans(source: str) -> Optional[List[Span]]:
+    """Диапазоны многострочных строковых литералов Python (включая f-строки); None, если код не разбирается."""
+    starts = {getattr(tokenize, name) for name in ("FSTRING_START", "TSTRING_START") if hasattr(tokenize, name)}
+    ends = {getattr(tokenize, name) for name in ("FSTRING_END", "TSTRING_END") if hasattr(tokenize, name)}
+    row_offsets = [0, 0]
+    row_offsets.extend(match.end() for match in re.finditer("\n", source))
+    spans: List[Span] = []
+    open_strings: List[Tuple[int, int]] = []
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+            if tok.type in starts:
+                open_strings.append(tok.start)
+                continue
+            if tok.type in ends and open_strings:
+                start = open_strings.pop()
+                if open_strings:
+                    continue
+            elif tok.type == tokenize.STRING and not open_strings:
+                start = tok.start
+            else:
+                continue
+            if start[0] != tok.end[0]:
+                spans.append((row_offsets[start[0]] + start[1], row_offsets[tok.end[0]] + tok.end[1]))
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    return spans
+
+def python_indents_fit(source: str, tab_size: int) -> bool:
+    """Проверяет, что все отступы блоков Python кратны tab_size (иначе --indent tabs смешает их с пробелами)."""
+    try:
+        return all(
+            len(tok.string.expandtabs(tab_size)) % tab_size == 0
+            for tok in tokenize.generate_tokens(io.StringIO(source).readline)
+            if tok.type == tokenize.INDENT
+        )
+    except (tokenize.TokenError, SyntaxError):
+        return False
+
+def python_compiles(source: str) -> bool:
+    """Проверяет, что исходный код Python компилируется."""
+    try:
+        compile(source, "<cleanup>", "exec", dont_inherit=True)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+def whitespace_protected_spans(text: str, file_type: Optional[str]) -> Optional[List[Span]]:
+    """Диапазоны, которые политика пробелов не трогает: <pre>/<textarea> в HTML, строки в Python."""
+    if file_type == "html":
+        return [match.span() for match in HTML_RAW_BLOCK_RE.finditer(text)]
+    if file_type == "py":
+        return python_string_spans(text)
+    return []
+
+def apply_whitespace_policy(
+    text: str, original: str, policy: WhitespacePolicy, file_type: Optional[str] = None
+) -> Tuple[str, WhitespaceStats]:
+    """Применяет политику отступов и последнего перевода строки; возвращает текст и (строк, байт).
+
+    Содержимое <pre>/<textarea> и многострочных строк Python не меняется; Python-файл,
+    который не удаётся разобрать на токены, остаётся как есть. Если смена отступов
+    ломает Python-файл (отступы не кратны tab_size, результат не компилируется),
+    возбуждается ValueError и файл пропускается.
+    """
+    final_newline = policy.final_newline
+    if final_newline == "keep":
+        final_newline = "ensure" if not original or original.endswith("\n") else "strip"
+    if policy.indent == "keep" and final_newline == "ensure":
+        return text, WhitespaceStats()
+    protected = whitespace_protected_spans(text, file_type)
+    if protected is None:
+        return text, WhitespaceStats()
+    reindent_py = file_type == "py" and policy.indent != "keep"
+    if reindent_py and policy.indent == "tabs" and not python_indents_fit(text, policy.tab_size):
+        raise ValueError(f"--indent tabs: отступы не кратны --tab-size {policy.tab_size}, файл пропущен")
+    result, lines, delta = normalize_whitespace(
+        text, policy.indent, policy.tab_size, final_newline, protected=protected
+    )
+    if reindent_py and result is not text and not python_compiles(result) and python_compiles(text):
+        raise ValueError(f"--indent {policy.indent}: после смены отступов файл не компилируется, файл пропущен")
+    return result, WhitespaceStats(lines, delta)
+
+def write_source(
+    path: Path,
+    new_data: bytes,
+    fsync: str = "none",
+    snapshot: Optional[SourceSnapshot] = None,
+    recheck: bool = False,
+) -> None:
+    """Атомарно записывает новые байты файла.
+
+    recheck — перед записью сверить stat со снимком и не затирать чужие изменения.
+    fsync: none — без сброса на диск, file — fsync файла и каталога,
+    batch — без fsync (сброс выполняет sync_written_files в конце пакета).
+    """
+    if recheck and snapshot is not None:
+        if not snapshot_state(snapshot).matches(os.stat(path)):
+            raise RuntimeError("файл изменён другим процессом во время обработки")
+    atomic_write_bytes(path, new_data, fsync == "file")
+
+def write_if_changed(
+    path: Path,
+    new_content: str,
+    dry_run: bool,
+    fsync: str = "none",
+    snapshot: Optional[SourceSnapshot] = None,
+    recheck: bool = False,
+) -> bool:
+    """Записывает контент атомарно в исходной кодировке и с исходными переводами строк, если он изменился.
+
+    С snapshot (результат read_source) файл не перечитывается: сравниваются хеши байт.
+    """
+    if snapshot is None:
+        try:
+            loaded = read_source(path)
+        except (OSError, UnicodeDecodeError, SyntaxError):
+            loaded = None
+        if loaded is not None:
+            original, snapshot = loaded
+            if original == new_content:
+                return False
+    if snapshot is None:
+        new_data = new_content.encode("utf-8")
+    else:
+        new_data = encode_source(new_content, snapshot.encoding, snapshot.newline)
+    if snapshot is not None and content_hash(new_data) == snapshot.digest:
         return False
     if dry_run:
         return True
-    path.write_text(new_content, encoding="utf-8")
+    write_source(path, new_data, fsync, snapshot, recheck)
     return True
 
+def content_hash(data: bytes) -> str:
+    """Вычисляет хеш содержимого файла."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def file_content_hash(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """Хеш содержимого файла (как content_hash), читая его блоками, а не целиком."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as handle:
+        for block in iter(partial(handle.read, chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def config_fingerprint(
+    args: argparse.Namespace, tool_versions: Optional[Dict[str, str]] = None
+) -> str:
+    """Строит отпечаток настроек, влияющих на результат обработки.
+
+    tool_versions — найденные инструменты и их версии: появление или обновление
+    форматтера делает прежние записи --incremental недействительными.
+    """
+    relevant: Dict[str, Any] = {
+        key: value for key, value in sorted(vars(args).items())
+        if key not in STATE_NEUTRAL_ARGS
+    }
+    for key in ("keep_py_keywords", "keep_sh_keywords"):
+        if isinstance(relevant.get(key), str):
+            relevant[key] = sorted(parse_keep_keywords(relevant[key]))
+    if tool_versions:
+        relevant["tools"] = tool_versions
+    payload = json.dumps(relevant, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+class StateCache:
+    """Хранит состояние обработанных файлов между запусками (sqlite)."""
+
+    def __init__(self, cache_dir: Path, config_key: str):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.config_key = config_key
+        self.conn = sqlite3.connect(str(cache_dir / "state.sqlite3"))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "content_hash TEXT, tool_version TEXT, config TEXT)"
+        )
+        self.entries: Dict[str, Tuple[int, int, int, str, str]] = {
+            row[0]: tuple(row[1:])
+            for row in self.conn.execute(
+                "SELECT path, size, mtime_ns, inode, tool_version, config FROM files"
+            )
+        }
+
+    def is_clean(self, path: Path, st: os.stat_result) -> bool:
+        """Проверяет, что файл не менялся с момента последней успешной обработки."""
+        entry = self.entries.get(str(path))
+        return entry == (
+            st.st_size, st.st_mtime_ns, st.st_ino, TOOL_VERSION, self.config_key
+        )
+
+    def record(self, path: Path, known: Optional[FileState] = None) -> None:
+        """Запоминает текущее состояние файла как обработанное.
+
+        known — состояние из process_file: если stat совпадает, файл не перечитывается,
+        иначе хешируется блоками (большие файлы не загружаются в память целиком).
+        """
+        st = path.stat()
+        if known is not None and known.matches(st):
+            digest = known.digest
+        else:
+            digest = file_content_hash(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(path), st.st_size, st.st_mtime_ns, st.st_ino, digest,
+             TOOL_VERSION, self.config_key),
+        )
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+def partition_by_state(
+    files: Dict[str, List[Path]], state: StateCache
+) -> Tuple[Dict[str, List[Path]], int]:
+    """Отбрасывает файлы, которые не менялись с прошлого запуска."""
+    pending: Dict[str, List[Path]] = {}
+    skipped = 0
+    for file_type, paths in files.items():
+        pending[file_type] = []
+        for path in paths:
+            try:
+                if state.is_clean(path, path.stat()):
+                    skipped += 1
+                    continue
+            except OSError:
+                pass
+            pending[file_type].append(path)
+    return pending, skipped
+
+PROJECT_CONFIG_FILES = (
+    "pyproject.toml", "setup.cfg", "tox.ini", ".isort.cfg", "ruff.toml", ".ruff.toml",
+    ".editorconfig", ".shellcheckrc",
+)
+
+PATH_INDEPENDENT_TOOLS = frozenset({"black-lib", "shfmt"})
+
+class ToolResultCache:
+    """Контентно-адресуемый кеш результатов внешних инструментов с LRU-вытеснением."""
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.root = cache_dir / "tools"
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(identity: Tuple[str, ...], digest: str, scope: str = "") -> str:
+        """Строит ключ из (инструмент, версия, аргументы, ...), области файла (file_scope) и хеша входных данных."""
+        payload = "\0".join((*identity, scope, digest))
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=20).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Возвращает сохранённый результат и отмечает его как недавно использованный."""
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Атомарно сохраняет результат (ошибки записи в кеш игнорируются)."""
+        path = self._path(key)
+        tmp = path.with_name(f"{key}.{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def evict(self) -> int:
+        """Удаляет давно не использованные записи, пока кеш больше лимита."""
+        entries: List[Tuple[int, int, str]] = []
+        total = 0
+        try:
+            buckets = list(os.scandir(self.root))
+        except OSError:
+            return 0
+        for bucket in buckets:
+            try:
+                with os.scandir(bucket.path) as files:
+                    for entry in files:
+                        st = entry.stat()
+                        entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                        total += st.st_size
+            except OSError:
+                continue
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        target = self.max_bytes * 9 // 10
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+@lru_cache(maxsize=None)
+def config_digest_for(directory: Path) -> str:
+    """Хеш конфигурационных файлов в каталоге и во всех его предках (инструменты ищут их вверх по дереву)."""
+    digest = hashlib.blake2b(digest_size=16)
+    if directory.parent != directory:
+        digest.update(config_digest_for(directory.parent).encode())
+    for name in PROJECT_CONFIG_FILES:
+        try:
+            data = (directory / name).read_bytes()
+        except OSError:
+            continue
+        digest.update(f"{name}\0{len(data)}\0".encode() + data)
+    return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+def scope_root(directory: Path) -> Path:
+    """Корень, от которого считается путь файла в ключе кеша.
+
+    Репозиторий git, иначе ближайший каталог с конфигурацией проекта, иначе корень файловой системы.
+    """
+    git_root = find_git_toplevel(directory)
+    if git_root is not None:
+        return git_root
+    for candidate in (directory, *directory.parents):
+        if any((candidate / name).is_file() for name in PROJECT_CONFIG_FILES):
+            return candidate
+    return Path(directory.anchor)
+
+def file_scope(tool: str, file_path: Path) -> str:
+    """Область ключа кеша для файла: конфиги его предков и путь от корня проекта.
+
+    Путь не учитывается только для инструментов из PATH_INDEPENDENT_TOOLS; остальные
+    применяют правила по путям (per-file-ignores, skip, force-exclude).
+    """
+    directory = Path(os.path.abspath(file_path)).parent
+    scope = config_digest_for(directory)
+    if tool in PATH_INDEPENDENT_TOOLS:
+        return scope
+    return f"{scope}\0{relative_posix(directory, scope_root(directory))}/{file_path.name}"
+
+def tool_identity(tool: str, version: str, args: Iterable[str]) -> Tuple[str, ...]:
+    """Идентичность запуска инструмента для ключа кеша (без учёта конфигов: см. file_scope)."""
+    return (tool, version, *args)
+
+def cached_stage(
+    cache: ToolResultCache,
+    identity: Tuple[str, ...],
+    stage: "PipelineStage",
+    content: str,
+    file_path: Path,
+    encoding: str,
+) -> str:
+    """Этап конвейера с кешированием результата по хешу содержимого (ошибки не кешируются)."""
+    data = content.encode("utf-8")
+    scope = file_scope(identity[0], file_path)
+    key = cache.make_key(identity, content_hash(data), scope)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached.decode("utf-8")
+    result = stage(content, file_path, encoding)
+    encoded = result.encode("utf-8")
+    cache.put(key, encoded)
+    cache.put(cache.make_key(identity, content_hash(encoded), scope), encoded)
+    return result
+
+class FileResult(NamedTuple):
+    """Итог обработки файла: изменён ли, ошибка, сэкономлено байт, статистика пробелов, состояние.
+
+    tool_errors — сообщения форматтеров конвейера (--pipeline), завершившихся с ошибкой.
+    """
+
+    changed: bool
+    error: Optional[str] = None
+    saved: int = 0
+    whitespace: WhitespaceStats = WhitespaceStats()
+    state: Optional[FileState] = None
+    tool_errors: Tuple[str, ...] = ()
+
+def contains_markers(data: Any, size: int, markers: Tuple[bytes, ...]) -> bool:
+    """Ищет в байтах (bytes или mmap) маркеры комментариев и лишних пробелов."""
+    if data[size - 1:size] != b"\n":
+        return True
+    return any(data.find(marker) >= 0 for marker in (*markers, *WHITESPACE_MARKERS))
+
+class StageError(Exception):
+    """Ошибка этапа конвейера: инструмент, код возврата и его stderr."""
+
+PipelineStage = Callable[[str, Path, str], str]
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def stream_web_file(
+    file_path: Path,
+    dry_run: bool,
+    fsync: str = "none",
+    recheck: bool = False,
+    newline_policy: str = "preserve",
+    markers: Optional[Tuple[bytes, ...]] = None,
+    language: str = "html",
+    minify: bool = False,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+    threshold: int = 0,
+) -> Optional[FileResult]:
+    """Потоково обрабатывает большой .html/.css/.js файл с памятью O(chunk_size).
+
+    Файл читается окнами mmap, состояние лексера и чистки пробелов переносится между окнами,
+    результат пишется во временный файл рядом и заменяет исходный, только если отличается.
+    В режиме dry_run результат только хешируется, временный файл не создаётся.
+    Для файлов меньше threshold возвращает None (обычная обработка в памяти).
+    """
+    target = file_path.resolve() if file_path.is_symlink() else file_path
+    if target.stat().st_size < max(threshold, 1):
+        return None
+    tmp = None if dry_run else temp_path_for(target)
+    out: Optional[BinaryIO] = None
+    try:
+        with open(target, "rb") as handle, mmap.mmap(
+            handle.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            st = os.fstat(handle.fileno())
+            size = len(data)
+            if markers is not None and not contains_markers(data, size, markers):
+                return FileResult(False, state=FileState.from_stat(content_hash(data), st))
+            newline = target_newline("\r\n" if data.find(b"\r\n") >= 0 else "\n", newline_policy)
+            normalizer = WhitespaceNormalizer()
+            lexer = WebCommentLexer(language, minify) if language != "html" else None
+            stripper = HtmlCommentStripper(minify, normalizer) if language == "html" else None
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            source_hash = hashlib.blake2b(digest_size=16)
+            output_hash = hashlib.blake2b(digest_size=16)
+            output_size = 0
+            carry = ""
+            if tmp is not None:
+                out = open(tmp, "wb")
+            for pos in range(0, size, chunk_size):
+                window = data[pos:pos + chunk_size]
+                source_hash.update(window)
+                final = pos + chunk_size >= size
+                text = carry + decoder.decode(window, final)
+                carry = ""
+                if not final and text.endswith("\r"):
+                    text, carry = text[:-1], "\r"
+                if "\r" in text:
+                    text = text.replace("\r\n", "\n").replace("\r", "\n")
+                if stripper is not None:
+                    pieces = [stripper.feed(text)]
+                    if final:
+                        pieces.extend((stripper.finish(), normalizer.finish()))
+                else:
+                    assert lexer is not None
+                    pieces = [normalizer.feed(lexer.feed(text))]
+                    if final:
+                        pieces.extend((normalizer.feed(lexer.finish()), normalizer.finish()))
+                chunk = "".join(pieces)
+                if newline != "\n":
+                    chunk = chunk.replace("\n", newline)
+                encoded = chunk.encode("utf-8")
+                output_hash.update(encoded)
+                output_size += len(encoded)
+                if out is not None:
+                    out.write(encoded)
+            changed = output_hash.digest() != source_hash.digest()
+            if out is not None:
+                if changed and fsync == "file":
+                    out.flush()
+                    os.fsync(out.fileno())
+                out.close()
+    except BaseException:
+        if out is not None:
+            out.close()
+        if tmp is not None:
+            discard_temp(tmp)
+        raise
+    source_state = FileState.from_stat(source_hash.hexdigest(), st)
+    if not changed:
+        if tmp is not None:
+            discard_temp(tmp)
+        return FileResult(False, state=source_state)
+    if tmp is None:
+        return FileResult(True, saved=st.st_size - output_size)
+    if recheck and not source_state.matches(os.stat(target)):
+        discard_temp(tmp)
+        raise RuntimeError("файл изменён другим процессом во время обработки")
+    replace_with_temp(tmp, target, fsync == "file")
+    new_st = target.stat()
+    return FileResult(
+        True, saved=st.st_size - output_size,
+        state=FileState.from_stat(output_hash.hexdigest(), new_st),
+    )
+
+def process_file(
+    file_path: Path,
+    processor: Callable[[str], str],
+    dry_run: bool,
+    stages: Tuple[PipelineStage, ...] = (),
+    markers: Optional[Tuple[bytes, ...]] = None,
+    fsync: str = "none",
+    recheck: bool = False,
+    whitespace: WhitespacePolicy = DEFAULT_WHITESPACE_POLICY,
+    streamer: Optional[Callable[..., Optional[FileResult]]] = None,
+) -> FileResult:
+    """Читает, обрабатывает и при необходимости записывает один файл.
+
+    Если заданы markers, файл без них не декодируется и считается неизменённым.
+    Файл пишется обратно в той же кодировке, в которой был прочитан (PEP 263),
+    с переводами строк по политике whitespace.
+    Возвращает признак изменения, текст ошибки, число сэкономленных байт, (строк, байт),
+    изменённых политикой пробелов, и состояние файла на диске после обработки (для StateCache.record).
+    streamer (stream_web_file) забирает большие файлы, если политика пробелов это допускает.
+    """
+    try:
+        if streamer is not None and not stages and not whitespace.rewrites_text():
+            streamed = streamer(file_path, dry_run, fsync, recheck, whitespace.newline, markers)
+            if streamed is not None:
+                return streamed
+        loaded = read_source(file_path, markers)
+        if loaded is None:
+            return FileResult(False)
+        original, snapshot = loaded
+        cleaned = processor(original)
+        tool_errors: Tuple[str, ...] = ()
+        if stages:
+            cleaned, tool_errors = run_pipeline_stages(cleaned, file_path, snapshot.encoding, stages)
+        cleaned, ws_stats = apply_whitespace_policy(
+            cleaned, original, whitespace, classify_name(file_path.name)
+        )
+        newline = target_newline(snapshot.newline, whitespace.newline)
+        if cleaned == original and newline == snapshot.newline:
+            return FileResult(False, state=snapshot_state(snapshot), tool_errors=tool_errors)
+        new_data = encode_source(cleaned, snapshot.encoding, newline)
+        saved = snapshot.stat.st_size - len(new_data)
+        if dry_run:
+            return FileResult(True, saved=saved, whitespace=ws_stats, tool_errors=tool_errors)
+        write_source(file_path, new_data, fsync, snapshot, recheck)
+        state = FileState.from_stat(content_hash(new_data), file_path.stat())
+        return FileResult(True, saved=saved, whitespace=ws_stats, state=state, tool_errors=tool_errors)
+    except Exception as e:
+        return FileResult(False, error=str(e))
+
+def process_files(
+    files: List[Path],
+    processor: Callable[[str], str],
+    dry_run: bool,
+    pool: Optional[ProcessPoolExecutor] = None,
+    jobs: int = 1,
+    stages: Tuple[PipelineStage, ...] = (),
+    markers: Optional[Tuple[bytes, ...]] = None,
+    fsync: str = "none",
+    recheck: bool = False,
+    whitespace: WhitespacePolicy = DEFAULT_WHITESPACE_POLICY,
+    streamer: Optional[Callable[..., Optional[FileResult]]] = None,
+) -> List[FileResult]:
+    """Обрабатывает файлы последовательно или в пуле процессов, сохраняя порядок."""
+    results: List[FileResult] = []
+    if pool is not None:
+        chunksize = max(1, len(files) // (jobs * 4))
+        try:
+            for result in pool.map(
+                process_file, files, repeat(processor), repeat(dry_run), repeat(stages),
+                repeat(markers), repeat(fsync), repeat(recheck), repeat(whitespace),
+                repeat(streamer), chunksize=chunksize,
+            ):
+                results.append(result)
+        except BrokenProcessPool:
+            print("[WARN] Пул процессов аварийно завершён, продолжаю последовательно.",
+                  file=sys.stderr)
+    for file_path in files[len(results):]:
+        results.append(process_file(
+            file_path, processor, dry_run, stages, markers, fsync, recheck, whitespace, streamer,
+        ))
+    return results
+
+def display_path(path: Path) -> Path:
+    """Возвращает путь относительно текущего каталога, если это возможно."""
+    try:
+        return path.relative_to(Path.cwd())
+    except ValueError:
+        return path
+
 def run_command(cmd: List[str]) -> int:
     """Выполняет команду в подпроцессе."""
     try:
@@ -173,51 +2028,983 @@ def run_command(cmd: List[str]) -> int:
         print(f"[ERROR] Команда '{cmd[0]}' не найдена.", file=sys.stderr)
         return 127
 
-def ensure_tool(cli_name: str, pip_name: Optional[str], allow_install: bool) -> bool:
-    """Проверяет наличие инструмента и при необходимости устанавливает его."""
-    if shutil.which(cli_name):
-        return True
-    if not pip_name:
-        print(f"[WARN] Инструмент '{cli_name}' не найден в PATH. Установите его вручную.")
-        return False
-    if not allow_install:
-        print(f"[WARN] Инструмент '{cli_name}' не найден. Пропускаю установку (--no-install).")
+def max_argv_bytes() -> int:
+    """Оценивает допустимый суммарный размер аргументов командной строки."""
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = 32768
+    env_bytes = sum(len(k) + len(v) + 2 for k, v in os.environ.items())
+    return max(4096, min(arg_max - env_bytes - 4096, MAX_SHARD_ARGV_BYTES))
+
+def shard_targets(
+    targets: List[str], jobs: int = 1, max_bytes: Optional[int] = None
+) -> List[List[str]]:
+    """Делит список аргументов на части по суммарной длине и числу ядер."""
+    if not targets:
+        return []
+    limit = max_bytes or max_argv_bytes()
+    sizes = [len(os.fsencode(t)) + 1 for t in targets]
+    wanted = max(1, min(jobs, -(-len(targets) // MIN_FILES_PER_SHARD)))
+    budget = max(1, min(limit, -(-sum(sizes) // wanted)))
+    shards: List[List[str]] = []
+    current: List[str] = []
+    current_size = 0
+    for target, size in zip(targets, sizes):
+        if current and current_size + size > budget:
+            shards.append(current)
+            current, current_size = [], 0
+        current.append(target)
+        current_size += size
+    shards.append(current)
+    return shards
+
+async def run_command_async(cmd: List[str], limit: asyncio.Semaphore) -> Tuple[int, str]:
+    """Выполняет команду асинхронно (не более limit одновременно); возвращает код и вывод."""
+    async with limit:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+            )
+        except FileNotFoundError:
+            print(f"[ERROR] Команда '{cmd[0]}' не найдена.", file=sys.stderr)
+            return 127, ""
+        output, _ = await proc.communicate()
+    return proc.returncode, output.decode("utf-8", errors="replace")
+
+async def run_shards(
+    cmd: List[str], targets: List[str], jobs: int, limit: asyncio.Semaphore
+) -> List[Tuple[List[str], int, str]]:
+    """Запускает команду для частей списка файлов параллельно: (часть, код, вывод)."""
+    prefix_bytes = sum(len(os.fsencode(arg)) + 1 for arg in cmd)
+    shards = shard_targets(targets, jobs, max_argv_bytes() - prefix_bytes)
+    results = await asyncio.gather(
+        *(run_command_async([*cmd, *shard], limit) for shard in shards)
+    )
+    return [(shard, code, output) for shard, (code, output) in zip(shards, results)]
+
+def report_tool_result(tool: str, code: int, output: str, cached: int = 0) -> None:
+    """Печатает итог инструмента и его вывод."""
+    suffix = f", из кеша: {cached}" if cached else ""
+    print(f"[INFO] {tool}: завершён (код {code}{suffix})")
+    if output.strip():
+        print(output.rstrip())
+
+def failed_targets(
+    results: List[Tuple[List[str], int, str]], ok_codes: Tuple[int, ...]
+) -> Set[str]:
+    """Файлы из частей, завершившихся с кодом не из ok_codes."""
+    return {target for shard, code, _ in results if code not in ok_codes for target in shard}
+
+async def run_sharded(
+    tool: str,
+    cmd: List[str],
+    targets: List[str],
+    jobs: int,
+    limit: asyncio.Semaphore,
+    ok_codes: Tuple[int, ...] = (0,),
+) -> Set[str]:
+    """Запускает команду для частей списка файлов параллельно; возвращает файлы из неудачных частей."""
+    results = await run_shards(cmd, targets, jobs, limit)
+    code = max((c for _, c, _ in results), default=0)
+    report_tool_result(tool, code, "".join(out for _, _, out in results))
+    return failed_targets(results, ok_codes)
+
+async def run_cached_formatter(
+    tool: str,
+    cmd: List[str],
+    identity: Tuple[str, ...],
+    files: List[Path],
+    cache: ToolResultCache,
+    jobs: int,
+    limit: asyncio.Semaphore,
+    ok_codes: Tuple[int, ...] = (0,),
+    fsync: str = "none",
+    written: Optional[List[Path]] = None,
+) -> Set[str]:
+    """Запускает форматтер только для файлов, которых нет в кеше результатов.
+
+    Результаты из кеша записываются по режиму fsync и добавляются в written (для batch).
+    Возвращает файлы, которые инструмент не смог обработать (код не из ok_codes).
+    """
+    misses: Dict[str, Tuple[str, str]] = {}
+    hits = 0
+    for file_path in files:
+        scope = file_scope(identity[0], file_path)
+        try:
+            data = file_path.read_bytes()
+        except OSError:
+            misses[str(file_path)] = ("", scope)
+            continue
+        key = cache.make_key(identity, content_hash(data), scope)
+        cached = cache.get(key)
+        if cached is None:
+            misses[str(file_path)] = (key, scope)
+            continue
+        hits += 1
+        if cached != data:
+            write_source(file_path, cached, fsync)
+            if written is not None:
+                written.append(file_path)
+    results = await run_shards(cmd, list(misses), jobs, limit)
+    for shard, code, _ in results:
+        if code != 0:
+            continue
+        for target in shard:
+            try:
+                formatted = Path(target).read_bytes()
+            except OSError:
+                continue
+            key, scope = misses[target]
+            if key:
+                cache.put(key, formatted)
+            cache.put(cache.make_key(identity, content_hash(formatted), scope), formatted)
+    code = max((c for _, c, _ in results), default=0)
+    report_tool_result(tool, code, "".join(out for _, _, out in results), hits)
+    return failed_targets(results, ok_codes)
+
+async def run_cached_diagnostics(
+    tool: str,
+    cmd: List[str],
+    identity: Tuple[str, ...],
+    files: List[Path],
+    cache: ToolResultCache,
+    jobs: int,
+    limit: asyncio.Semaphore,
+    ok_codes: Tuple[int, ...] = (0, 1),
+) -> Set[str]:
+    """Запускает анализатор (формат gcc) только для файлов без сохранённой диагностики.
+
+    Возвращает файлы, для которых анализатор завершился с кодом не из ok_codes.
+    """
+    reports: Dict[str, Tuple[int, str]] = {}
+    misses: Dict[str, str] = {}
+    for file_path in files:
+        try:
+            key = cache.make_key(
+                identity, content_hash(file_path.read_bytes()), file_scope(identity[0], file_path)
+            )
+        except OSError:
+            key = ""
+        cached = cache.get(key) if key else None
+        if cached is None:
+            misses[str(file_path)] = key
+        else:
+            code, lines = json.loads(cached)
+            reports[str(file_path)] = (code, "".join(f"{file_path}{line}\n" for line in lines))
+    hits = len(reports)
+    extra_output: List[str] = []
+    for shard, code, output in await run_shards(cmd, list(misses), jobs, limit):
+        if code not in ok_codes:
+            reports.update((target, (code, "")) for target in shard)
+            extra_output.append(output)
+            continue
+        per_file: Dict[str, List[str]] = {target: [] for target in shard}
+        for line in output.splitlines():
+            match = GCC_DIAGNOSTIC_RE.match(line)
+            if match and match.group(1) in per_file:
+                per_file[match.group(1)].append(line)
+            else:
+                extra_output.append(line + "\n")
+        for target, lines in per_file.items():
+            text = "".join(line + "\n" for line in lines)
+            reports[target] = (1 if lines else 0, text)
+            if misses[target]:
+                tails = [line[len(target):] for line in lines]
+                cache.put(misses[target], json.dumps((reports[target][0], tails)).encode("utf-8"))
+    ordered = [reports[str(p)] for p in files if str(p) in reports]
+    code = max((c for c, _ in ordered), default=0)
+    output = "".join(out for _, out in ordered) + "".join(extra_output)
+    report_tool_result(tool, code, output, hits)
+    return {target for target, (code, _) in reports.items() if code not in ok_codes}
+
+class ToolManager:
+    """Находит инструменты, кеширует их пути и версии между запусками.
+
+    Недостающие инструменты ставятся одним вызовом pip в отдельное venv в каталоге
+    кеша (из локального wheelhouse без обращения к индексу, если он задан).
+    """
+
+    def __init__(
+        self, cache_dir: Path, wheelhouse: Optional[Path] = None, allow_install: bool = True
+    ):
+        self.registry_path = cache_dir / "tools.json"
+        self.venv_dir = cache_dir / "venv"
+        self.wheelhouse = wheelhouse
+        self.allow_install = allow_install
+        self.resolved: Dict[str, Optional[str]] = {}
+        try:
+            self.registry: Dict[str, Dict[str, Any]] = json.loads(
+                self.registry_path.read_text(encoding="utf-8")
+            )
+        except (OSError, ValueError):
+            self.registry = {}
+
+    def venv_bin(self) -> Path:
+        return self.venv_dir / ("Scripts" if os.name == "nt" else "bin")
+
+    def _lookup(self, name: str) -> Optional[str]:
+        """Ищет инструмент: сначала в сохранённом реестре (по mtime), затем в PATH и venv."""
+        entry = self.registry.get(name)
+        if entry:
+            try:
+                if os.stat(entry["path"]).st_mtime_ns == entry["mtime_ns"]:
+                    return entry["path"]
+            except (OSError, KeyError):
+                pass
+        path = shutil.which(name) or shutil.which(name, path=str(self.venv_bin()))
+        if path is None:
+            self.registry.pop(name, None)
+            return None
+        path = os.path.abspath(path)
+        self.registry[name] = {"path": path, "mtime_ns": os.stat(path).st_mtime_ns}
+        return path
+
+    def _install(self, packages: List[str]) -> None:
+        """Устанавливает пакеты в отдельное venv одним вызовом pip.
+
+        Ошибки (нет ensurepip, каталог кеша недоступен для записи) печатаются,
+        инструменты остаются ненайденными, а обработка продолжается.
+        """
+        python = self.venv_bin() / ("python.exe" if os.name == "nt" else "python")
+        if not python.exists():
+            print(f"[INFO] Создаю окружение для инструментов: {self.venv_dir}")
+            try:
+                venv.create(str(self.venv_dir), with_pip=True, clear=self.venv_dir.exists())
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f"[ERROR] Не удалось создать окружение {self.venv_dir} ({e}); "
+                      f"установите {', '.join(packages)} вручную "
+                      "(на Debian/Ubuntu для venv нужен пакет python3-venv).", file=sys.stderr)
+                shutil.rmtree(self.venv_dir, ignore_errors=True)
+                return
+        cmd = [str(python), "-m", "pip", "install", "-q"]
+        if self.wheelhouse is not None:
+            cmd += ["--no-index", "--find-links", str(self.wheelhouse)]
+        print(f"[INFO] Устанавливаю: {', '.join(packages)}...")
+        try:
+            code = run_command([*cmd, *packages])
+        except OSError as e:
+            print(f"[ERROR] Не удалось запустить pip в {self.venv_dir}: {e}", file=sys.stderr)
+            return
+        if code != 0:
+            print(f"[ERROR] Не удалось установить {', '.join(packages)}. Код: {code}", file=sys.stderr)
+
+    def version(self, name: str) -> str:
+        """Возвращает версию инструмента (из реестра или через --version)."""
+        entry = self.registry.get(name)
+        if entry is None:
+            return "unknown"
+        if "version" not in entry:
+            try:
+                proc = subprocess.run(
+                    [entry["path"], "--version"], capture_output=True, text=True, check=False
+                )
+                lines = [
+                    line.strip() for line in (proc.stdout or proc.stderr).splitlines()
+                    if any(ch.isdigit() for ch in line)
+                ]
+                entry["version"] = lines[0] if lines else "unknown"
+            except OSError:
+                entry["version"] = "unknown"
+        return entry["version"]
+
+    def prepare(self, names: Iterable[str]) -> None:
+        """Разрешает инструменты параллельно и ставит недостающие."""
+        names = [n for n in dict.fromkeys(names) if n not in self.resolved]
+        if not names:
+            return
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            self.resolved.update(zip(names, pool.map(self._lookup, names)))
+        missing = [n for n in names if self.resolved[n] is None]
+        packages = [TOOL_PACKAGES[n] for n in missing if TOOL_PACKAGES.get(n)]
+        for name in missing:
+            if not TOOL_PACKAGES.get(name):
+                print(f"[WARN] Инструмент '{name}' не найден в PATH. Установите его вручную.")
+            elif not self.allow_install:
+                print(f"[WARN] Инструмент '{name}' не найден. Пропускаю установку (--no-install).")
+        if packages and self.allow_install:
+            self._install(packages)
+            for name in missing:
+                self.resolved[name] = self._lookup(name)
+        available = [n for n in names if self.resolved[n]]
+        if available:
+            with ThreadPoolExecutor(max_workers=len(available)) as pool:
+                list(pool.map(self.version, available))
+        self.save()
+
+    def ensure(self, name: str) -> bool:
+        """Проверяет наличие инструмента (при необходимости разрешая его)."""
+        if name not in self.resolved:
+            self.prepare([name])
+        return self.resolved[name] is not None
+
+    def command(self, name: str) -> List[str]:
+        """Команда запуска инструмента по абсолютному пути."""
+        return [self.resolved.get(name) or name]
+
+    def save(self) -> None:
+        """Сохраняет реестр инструментов (ошибки записи игнорируются)."""
+        tmp = self.registry_path.with_name(f"{self.registry_path.name}.{os.getpid()}.tmp")
+        try:
+            self.registry_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_text(json.dumps(self.registry, indent=2, sort_keys=True), encoding="utf-8")
+            os.replace(tmp, self.registry_path)
+        except OSError:
+            pass
+
+def required_tools(files: Dict[str, List[Path]], args: argparse.Namespace) -> List[str]:
+    """Список внешних инструментов, нужных для найденных файлов и заданных флагов."""
+    names: List[str] = []
+    if files.get("py") and args.py_toolchain == "ruff":
+        if not (args.skip_ruff and args.skip_isort and args.skip_black):
+            names.append("ruff")
+    elif files.get("py"):
+        names += [n for n, skip in (("ruff", args.skip_ruff), ("isort", args.skip_isort),
+                                    ("black", args.skip_black)) if not skip]
+    if files.get("sh"):
+        names += [n for n, skip in (("shellcheck", args.skip_shellcheck),
+                                    ("shfmt", args.skip_shfmt)) if not skip]
+    return names
+
+def toolchain_versions(
+    tools: ToolManager, names: Iterable[str], engine: str
+) -> Dict[str, str]:
+    """Версии инструментов, которые будут запущены ("missing" — не найден)."""
+    versions: Dict[str, str] = {}
+    for name in names:
+        module = import_formatter(name) if name in ("black", "isort") and engine != "subprocess" else None
+        if module is not None:
+            versions[name] = f"lib {getattr(module, '__version__', 'unknown')}"
+        elif tools.ensure(name):
+            versions[name] = tools.version(name)
+        else:
+            versions[name] = "missing"
+    return versions
+
+def stderr_tail(stderr: str, limit: int = 3) -> str:
+    """Последние непустые строки stderr инструмента — для сообщения об ошибке."""
+    lines = [line.strip() for line in stderr.splitlines() if line.strip()]
+    return " | ".join(lines[-limit:]) or "нет вывода в stderr"
+
+def exception_summary(error: Exception) -> str:
+    """Первая строка сообщения исключения форматтера-библиотеки (с типом исключения)."""
+    lines = str(error).strip().splitlines()
+    return f"{type(error).__name__}: {lines[0]}" if lines else type(error).__name__
+
+def pipe_through_tool(
+    cmd: List[str], content: str, ok_codes: Tuple[int, ...] = (0,), encoding: str = "utf-8"
+) -> str:
+    """Пропускает содержимое через инструмент (stdin → stdout).
+
+    Обмен идёт байтами в кодировке файла: black и isort декодируют stdin по BOM
+    и PEP 263, а не по UTF-8. При ошибке запуска или коде возврата вне ok_codes
+    бросает StageError с именем инструмента, кодом и хвостом stderr.
+    """
+    tool = Path(cmd[0]).name
+    try:
+        proc = subprocess.run(
+            cmd, input=encode_source(content, encoding), capture_output=True, check=False
+        )
+    except OSError as e:
+        raise StageError(f"{tool}: не удалось запустить: {e}") from e
+    stderr = proc.stderr.decode("utf-8", errors="replace")
+    if proc.returncode not in ok_codes:
+        raise StageError(f"{tool}: код {proc.returncode}: {stderr_tail(stderr)}")
+    try:
+        return decode_source(proc.stdout, encoding)
+    except UnicodeDecodeError as e:
+        raise StageError(f"{tool}: вывод не в кодировке {encoding}: {e}") from e
+
+def command_stage(
+    cmd: Tuple[str, ...], ok_codes: Tuple[int, ...], content: str, file_path: Path, encoding: str
+) -> str:
+    """Этап конвейера: внешняя команда в режиме stdin/stdout ("{path}" — путь файла)."""
+    argv = [str(file_path) if arg == "{path}" else arg for arg in cmd]
+    return pipe_through_tool(argv, content, ok_codes, encoding)
+
+@lru_cache(maxsize=None)
+def import_formatter(module_name: str) -> Optional[ModuleType]:
+    """Импортирует форматтер как библиотеку; None, если он не установлен."""
+    try:
+        return importlib.import_module(module_name)
+    except Exception:
+        return None
+
+def use_inprocess(module_name: str, engine: str) -> bool:
+    """Решает, можно ли запустить инструмент в текущем процессе."""
+    if engine == "subprocess":
         return False
-    print(f"[INFO] Устанавливаю '{pip_name}'...")
-    code = run_command([sys.executable, "-m", "pip", "install", "-q", pip_name])
-    if code != 0:
-        print(f"[ERROR] Не удалось установить '{pip_name}'. Код: {code}", file=sys.stderr)
+    if import_formatter(module_name) is not None:
+        return True
+    if engine == "inprocess":
+        print(f"[WARN] Не удалось импортировать '{module_name}', использую подпроцесс.")
+    return False
+
+BLACK_NEUTRAL_KEYS = frozenset({
+    "line_length", "include", "exclude", "extend_exclude", "force_exclude", "fast", "check", "diff",
+    "color", "quiet", "verbose", "workers", "cache_dir", "no_cache",
+})
+
+BLACK_MODE_KEYS = frozenset({
+    "target_version", "pyi", "ipynb", "skip_source_first_line", "skip_string_normalization",
+    "skip_magic_trailing_comma", "preview", "unstable", "enable_unstable_feature", "python_cell_magics",
+})
+
+class BlackSettings(NamedTuple):
+    """Настройки black для запуска в процессе: Mode, корень проекта, force-exclude и отпечаток конфига."""
+
+    mode: Any
+    root: Path
+    force_exclude: Optional["re.Pattern[str]"]
+    fingerprint: str
+
+def load_black_settings(line_length: int, files: List[Path]) -> Optional[BlackSettings]:
+    """Собирает black.Mode из [tool.black] проекта так же, как это делает `python -m black`.
+
+    --line-length из командной строки имеет приоритет над конфигом. exclude/extend-exclude
+    black применяет только при обходе каталогов, для явно переданных файлов — только force-exclude.
+    Возвращает None, если конфиг содержит настройки, которые нельзя воспроизвести в процессе.
+    """
+    black = import_formatter("black")
+    srcs = tuple(str(p) for p in files) or (str(Path.cwd()),)
+    try:
+        found = black.find_project_root(srcs)
+        root = Path(found[0] if isinstance(found, tuple) else found)
+        config_path = black.find_pyproject_toml(srcs)
+        config: Dict[str, Any] = black.parse_pyproject_toml(config_path) if config_path else {}
+        unsupported = sorted(set(config) - BLACK_NEUTRAL_KEYS - BLACK_MODE_KEYS)
+        if unsupported:
+            print(f"[INFO] black: настройки {', '.join(unsupported)} в {config_path} "
+                  "не поддерживаются в процессе, использую подпроцесс.")
+            return None
+        options: Dict[str, Any] = {
+            "target_versions": {black.TargetVersion[v.upper()] for v in config.get("target_version", ())},
+            "line_length": line_length,
+            "is_pyi": bool(config.get("pyi", False)),
+            "is_ipynb": bool(config.get("ipynb", False)),
+            "skip_source_first_line": bool(config.get("skip_source_first_line", False)),
+            "string_normalization": not config.get("skip_string_normalization", False),
+            "magic_trailing_comma": not config.get("skip_magic_trailing_comma", False),
+            "preview": bool(config.get("preview", False)),
+        }
+        if "unstable" in config:
+            options["unstable"] = bool(config["unstable"])
+        if "enable_unstable_feature" in config:
+            options["enabled_features"] = {black.Preview[f] for f in config["enable_unstable_feature"]}
+        if "python_cell_magics" in config:
+            options["python_cell_magics"] = set(config["python_cell_magics"])
+        mode = black.Mode(**options)
+        force_exclude = config.get("force_exclude")
+        pattern = black.re_compile_maybe_verbose(force_exclude) if force_exclude else None
+    except Exception as e:
+        print(f"[WARN] black: не удалось применить конфигурацию проекта ({e}), использую подпроцесс.")
+        return None
+    fingerprint = json.dumps(
+        {key: value for key, value in config.items() if key not in BLACK_NEUTRAL_KEYS},
+        sort_keys=True, default=str,
+    )
+    return BlackSettings(mode, root.resolve(), pattern, fingerprint)
+
+ISORT_CONFIG_SECTIONS = {
+    ".isort.cfg": ("settings", "isort"),
+    "pyproject.toml": ("tool.isort",),
+    "setup.cfg": ("isort", "tool:isort"),
+    "tox.ini": ("isort", "tool:isort"),
+    ".editorconfig": ("*", "*.py", "**.py", "*.{py}"),
+}
+
+def has_isort_section(config_path: Path, sections: Tuple[str, ...]) -> bool:
+    """Есть ли в файле конфигурации секция, которую читает isort."""
+    try:
+        text = config_path.read_text(encoding="utf-8", errors="replace")
+    except OSError:
         return False
-    return shutil.which(cli_name) is not None
+    return any(re.search(rf"^\s*\[{re.escape(section)}\]", text, re.MULTILINE) for section in sections)
 
-def apply_formatting_tools(
-    files: Dict[str, List[Path]], args: argparse.Namespace
-) -> None:
-    """Применяет линтеры и форматтеры к файлам."""
+@lru_cache(maxsize=None)
+def isort_settings_root(directory: Path) -> Path:
+    """Каталог настроек isort для файлов каталога, как у `isort путь/к/файлу.py`.
+
+    Ближайший предок с секцией isort в одном из ISORT_CONFIG_SECTIONS, иначе корень проекта.
+    """
+    for candidate in (directory, *directory.parents):
+        if any(has_isort_section(candidate / name, sections) for name, sections in ISORT_CONFIG_SECTIONS.items()):
+            return candidate
+    return scope_root(directory)
+
+@lru_cache(maxsize=None)
+def isort_config(root: Path, line_length: int) -> Any:
+    """Создаёт (один раз на корень) настройки isort с конфигурацией из root."""
+    isort = import_formatter("isort")
+    return isort.Config(
+        settings_path=str(root), directory=str(root), profile="black", line_length=line_length
+    )
+
+def black_stage(mode: Any, content: str, file_path: Path, encoding: str) -> str:
+    """Этап конвейера: black как библиотека."""
+    black = import_formatter("black")
+    try:
+        return black.format_str(content, mode=mode)
+    except Exception as e:
+        raise StageError(f"black: {exception_summary(e)}") from e
+
+def unless_force_excluded(
+    pattern: "re.Pattern[str]", root: Path, stage: PipelineStage,
+    content: str, file_path: Path, encoding: str,
+) -> str:
+    """Пропускает файлы, подпадающие под force-exclude black (путь вида /a/b.py от корня проекта)."""
+    try:
+        rel = "/" + file_path.resolve().relative_to(root).as_posix()
+    except ValueError:
+        rel = "/" + file_path.as_posix().lstrip("/")
+    match = pattern.search(rel)
+    if match and match.group(0):
+        return content
+    return stage(content, file_path, encoding)
+
+def inprocess_black_stage(
+    engine: str, line_length: int, files: List[Path], cache: Optional[ToolResultCache] = None
+) -> Optional[PipelineStage]:
+    """Этап black в процессе с настройками проекта; None — запускать black подпроцессом."""
+    if not use_inprocess("black", engine):
+        return None
+    settings = load_black_settings(line_length, files)
+    if settings is None:
+        return None
+    identity = library_identity("black", (f"--line-length={line_length}", settings.fingerprint))
+    stage = with_cache(partial(black_stage, settings.mode), cache, identity)
+    if settings.force_exclude is not None:
+        stage = partial(unless_force_excluded, settings.force_exclude, settings.root, stage)
+    return stage
+
+def isort_stage(line_length: int, root: Path, content: str, file_path: Path, encoding: str) -> str:
+    """Этап конвейера: isort как библиотека."""
+    isort = import_formatter("isort")
+    try:
+        return isort.code(content, config=isort_config(root, line_length), file_path=file_path)
+    except isort.exceptions.FileSkipped:
+        return content
+    except Exception as e:
+        raise StageError(f"isort: {exception_summary(e)}") from e
+
+def rooted_isort_stage(
+    line_length: int, cache: Optional[ToolResultCache], identity: Tuple[str, ...],
+    content: str, file_path: Path, encoding: str,
+) -> str:
+    """Этап isort с настройками корня файла (isort_settings_root); корень входит в ключ кеша."""
+    root = isort_settings_root(Path(os.path.abspath(file_path)).parent)
+    stage = with_cache(partial(isort_stage, line_length, root), cache, (*identity, f"--settings-path={root}"))
+    return stage(content, file_path, encoding)
+
+def inprocess_isort_stage(
+    isort_args: Tuple[str, ...], line_length: int, cache: Optional[ToolResultCache] = None
+) -> PipelineStage:
+    """Этап isort в процессе: настройки ищутся от каждого файла, как у isort из командной строки."""
+    return partial(rooted_isort_stage, line_length, cache, library_identity("isort", isort_args))
+
+def run_pipeline_stages(
+    content: str, file_path: Path, encoding: str, stages: Tuple[PipelineStage, ...]
+) -> Tuple[str, Tuple[str, ...]]:
+    """Последовательно применяет форматтеры к содержимому в памяти.
+
+    Упавший этап пропускается; возвращает результат и сообщения об ошибках этапов.
+    """
+    errors: List[str] = []
+    for stage in stages:
+        try:
+            content = stage(content, file_path, encoding)
+        except StageError as e:
+            errors.append(str(e))
+    return content, tuple(errors)
+
+def apply_stage_to_shard(
+    stage: PipelineStage, fsync: str, files: List[Path]
+) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """Применяет этап к группе файлов на диске.
+
+    Возвращает пары (файл, сообщение об ошибке) и записанные файлы (для fsync=batch).
+    """
+    failures: List[Tuple[str, str]] = []
+    written: List[str] = []
+    for file_path in files:
+        try:
+            original, snapshot = read_source(file_path)
+            result = stage(original, file_path, snapshot.encoding)
+            if result != original and write_if_changed(file_path, result, False, fsync, snapshot):
+                written.append(str(file_path))
+        except Exception as e:
+            failures.append((str(file_path), str(e)))
+    return failures, written
+
+def thread_safe_mp_context() -> Any:
+    """Контекст multiprocessing без fork: цикл событий asyncio держит потоки, fork из них небезопасен."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def with_cache(
+    stage: PipelineStage, cache: Optional[ToolResultCache], identity: Tuple[str, ...]
+) -> PipelineStage:
+    """Оборачивает этап кешем результатов, если кеш включён."""
+    return partial(cached_stage, cache, identity, stage) if cache is not None else stage
+
+def library_identity(module_name: str, args: Iterable[str]) -> Tuple[str, ...]:
+    """Идентичность форматтера, запускаемого как библиотека."""
+    version = getattr(import_formatter(module_name), "__version__", "unknown")
+    return tool_identity(f"{module_name}-lib", str(version), args)
+
+def ruff_toolchain_args(
+    args: argparse.Namespace,
+) -> Tuple[Optional[Tuple[str, ...]], Optional[Tuple[str, ...]]]:
+    """Аргументы ruff check/ruff format, заменяющие связку ruff + isort + black.
+
+    --skip-ruff убирает правила F, --skip-isort — правила I, --skip-black — ruff format.
+    """
+    line_length = f"--line-length={args.line_length}"
+    rules = [rule for rule, skip in (("F", args.skip_ruff), ("I", args.skip_isort)) if not skip]
+    check = ("check", "--select", ",".join(rules), "--fix", line_length) if rules else None
+    fmt = None if args.skip_black else ("format", line_length)
+    return check, fmt
+
+def build_pipeline_stages(
+    files: Dict[str, List[Path]],
+    args: argparse.Namespace,
+    tools: ToolManager,
+    cache: Optional[ToolResultCache] = None,
+) -> Dict[str, Tuple[PipelineStage, ...]]:
+    """Собирает цепочки форматтеров для --pipeline (только для найденных типов файлов)."""
+    line_length = args.line_length
+    engine = args.tool_engine
+    py_stages: List[PipelineStage] = []
+    sh_stages: List[PipelineStage] = []
+    has_py = bool(files.get("py"))
+    isort_args = ("--profile", "black", f"--line-length={line_length}")
+    black_args = (f"--line-length={line_length}",)
+    classic = has_py and args.py_toolchain == "classic"
+    if has_py and args.py_toolchain == "ruff" and tools.ensure("ruff"):
+        check_args, format_args = ruff_toolchain_args(args)
+        for tool_args, ok_codes in ((check_args, (0, 1)), (format_args, (0,))):
+            if tool_args is None:
+                continue
+            if tool_args is check_args:
+                tool_args = (*tool_args, "--quiet")
+            cmd = (*tools.command("ruff"), *tool_args, "--stdin-filename", "{path}", "-")
+            py_stages.append(with_cache(
+                partial(command_stage, cmd, ok_codes), cache,
+                tool_identity("ruff", tools.version("ruff"), tool_args),
+            ))
+    if classic and not args.skip_ruff and tools.ensure("ruff"):
+        py_stages.append(partial(
+            command_stage,
+            (*tools.command("ruff"), "check", "--select", "F", "--fix", "--quiet",
+             "--stdin-filename", "{path}", "-"),
+            (0, 1),
+        ))
+    if classic and not args.skip_isort:
+        if use_inprocess("isort", engine):
+            py_stages.append(inprocess_isort_stage(isort_args, line_length, cache))
+        elif tools.ensure("isort"):
+            prefix = tuple(tools.command("isort"))
+            cmd = (*prefix, *isort_args, "--filename", "{path}", "-")
+            py_stages.append(with_cache(
+                partial(command_stage, cmd, (0,)), cache,
+                tool_identity("isort", tools.version("isort"), cmd[len(prefix):]),
+            ))
+    if classic and not args.skip_black:
+        black_inprocess = inprocess_black_stage(engine, line_length, files["py"], cache)
+        if black_inprocess is not None:
+            py_stages.append(black_inprocess)
+        elif tools.ensure("black"):
+            prefix = tuple(tools.command("black"))
+            cmd = (*prefix, *black_args, "--quiet", "--stdin-filename", "{path}", "-")
+            py_stages.append(with_cache(
+                partial(command_stage, cmd, (0,)), cache,
+                tool_identity("black", tools.version("black"), cmd[len(prefix):]),
+            ))
+    if files.get("sh") and not args.skip_shfmt and tools.ensure("shfmt"):
+        cmd = (*tools.command("shfmt"), "-i", "4")
+        sh_stages.append(with_cache(
+            partial(command_stage, cmd, (0,)), cache,
+            tool_identity("shfmt", tools.version("shfmt"), cmd[1:]),
+        ))
+    return {"py": tuple(py_stages), "sh": tuple(sh_stages)}
+
+ToolStep = Tuple[str, Callable[[asyncio.Semaphore], Awaitable[Set[str]]]]
+
+async def run_stage_in_executor(
+    tool: str,
+    stage: PipelineStage,
+    files: List[Path],
+    jobs: int,
+    limit: asyncio.Semaphore,
+    fsync: str = "none",
+    written: Optional[List[Path]] = None,
+) -> Set[str]:
+    """Выполняет этап как библиотеку, не блокируя цикл событий.
+
+    Группы файлов распределяются по пулу процессов (не больше jobs), и каждая группа
+    на время работы занимает слот limit — общий с подпроцессами других цепочек.
+    Файлы пишутся по режиму fsync; записанные добавляются в written (для batch).
+    """
+    apply_stage = partial(apply_stage_to_shard, stage, fsync)
+    loop = asyncio.get_running_loop()
+    workers = max(1, min(jobs, -(-len(files) // MIN_FILES_PER_SHARD)))
+    if workers <= 1:
+        async with limit:
+            shards = [await loop.run_in_executor(None, apply_stage, files)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=thread_safe_mp_context()) as pool:
+
+            async def run_shard(shard: List[Path]) -> Tuple[List[Tuple[str, str]], List[str]]:
+                async with limit:
+                    try:
+                        return await loop.run_in_executor(pool, apply_stage, shard)
+                    except BrokenProcessPool:
+                        return await loop.run_in_executor(None, apply_stage, shard)
+
+            shards = await asyncio.gather(*(run_shard(files[i::workers]) for i in range(workers)))
+    failures: Set[str] = set()
+    if written is not None:
+        written.extend(Path(target) for _, shard_written in shards for target in shard_written)
+    for target, message in sorted(failure for shard_failures, _ in shards for failure in shard_failures):
+        print(f"[WARN] {display_path(Path(target))}: {message}", file=sys.stderr)
+        failures.add(target)
+    if failures:
+        print(f"[WARN] {tool}: не удалось обработать файлов: {len(failures)}", file=sys.stderr)
+    print(f"[INFO] {tool}: завершён")
+    return failures
+
+async def run_tool_chain(chain: List[ToolStep], limit: asyncio.Semaphore) -> Set[str]:
+    """Выполняет инструменты одной цепочки строго по порядку; возвращает файлы с ошибками."""
+    failures: Set[str] = set()
+    for message, action in chain:
+        print(message)
+        failures |= await action(limit)
+    return failures
+
+async def run_tool_chains(chains: List[List[ToolStep]], jobs: int) -> Set[str]:
+    """Запускает независимые цепочки инструментов одновременно."""
+    limit = asyncio.Semaphore(jobs)
+    results = await asyncio.gather(*(run_tool_chain(chain, limit) for chain in chains))
+    return set().union(*results)
+
+def build_tool_chains(
+    files: Dict[str, List[Path]],
+    args: argparse.Namespace,
+    formatted_types: Set[str],
+    jobs: int,
+    tools: ToolManager,
+    cache: Optional[ToolResultCache] = None,
+    written: Optional[List[Path]] = None,
+) -> List[List[ToolStep]]:
+    """Собирает цепочки инструментов для .py и .sh файлов (порядок внутри цепочки важен).
+
+    Файлы, которые инструменты пишут сами (в процессе и из кеша), добавляются в written.
+    """
     py_files = files.get("py", [])
     sh_files = files.get("sh", [])
-    allow_install = not args.no_install
     line_length = args.line_length
+    engine = args.tool_engine
+    py_chain: List[ToolStep] = []
+    sh_chain: List[ToolStep] = []
+
+    def external_step(
+        tool: str, tool_args: Tuple[str, ...],
+        targets: List[Path], tool_jobs: int, diagnostics: bool = False,
+        ok_codes: Tuple[int, ...] = (0,),
+    ) -> Callable[[asyncio.Semaphore], Awaitable[Set[str]]]:
+        prefix = tools.command(tool)
+        if cache is None:
+            return partial(run_sharded, tool, [*prefix, *tool_args],
+                           [str(p) for p in targets], tool_jobs, ok_codes=ok_codes)
+        if diagnostics:
+            tool_args = (*tool_args, "--format=gcc")
+        identity = tool_identity(tool, tools.version(tool), tool_args)
+        if diagnostics:
+            return partial(run_cached_diagnostics, tool, [*prefix, *tool_args], identity, targets,
+                           cache, tool_jobs, ok_codes=ok_codes)
+        return partial(run_cached_formatter, tool, [*prefix, *tool_args], identity, targets,
+                       cache, tool_jobs, ok_codes=ok_codes, fsync=args.fsync, written=written)
 
-    if py_files:
-        py_targets = [str(p) for p in py_files]
-        if not args.skip_ruff and ensure_tool("ruff", "ruff", allow_install):
-            print("[INFO] Запуск: ruff (удаление неиспользуемых импортов/переменных)")
-            run_command([sys.executable, "-m", "ruff", "check", "--select", "F", "--fix", *py_targets])
-        if not args.skip_isort and ensure_tool("isort", "isort", allow_install):
-            print("[INFO] Запуск: isort (сортировка импортов)")
-            run_command([sys.executable, "-m", "isort", "--profile", "black", f"--line-length={line_length}", *py_targets])
-        if not args.skip_black and ensure_tool("black", "black", allow_install):
-            print("[INFO] Запуск: black (форматирование кода)")
-            run_command([sys.executable, "-m", "black", f"--line-length={line_length}", *py_targets])
+    if py_files and "py" not in formatted_types and args.py_toolchain == "ruff":
+        check_args, format_args = ruff_toolchain_args(args)
+        if (check_args or format_args) and tools.ensure("ruff"):
+            if check_args:
+                py_chain.append((
+                    "[INFO] Запуск: ruff check (импорты и неиспользуемый код)",
+                    external_step("ruff", check_args, py_files, 1, ok_codes=(0, 1)),
+                ))
+            if format_args:
+                py_chain.append((
+                    "[INFO] Запуск: ruff format (форматирование кода)",
+                    external_step("ruff", format_args, py_files, 1),
+                ))
+    elif py_files and "py" not in formatted_types:
+        if not args.skip_ruff and tools.ensure("ruff"):
+            py_chain.append((
+                "[INFO] Запуск: ruff (удаление неиспользуемых импортов/переменных)",
+                partial(run_sharded, "ruff",
+                        [*tools.command("ruff"), "check", "--select", "F", "--fix"],
+                        [str(p) for p in py_files], 1, ok_codes=(0, 1)),
+            ))
+        isort_args = ("--profile", "black", f"--line-length={line_length}")
+        if not args.skip_isort:
+            if use_inprocess("isort", engine):
+                stage = inprocess_isort_stage(isort_args, line_length, cache)
+                py_chain.append((
+                    "[INFO] Запуск: isort (сортировка импортов, в процессе)",
+                    partial(run_stage_in_executor, "isort", stage, py_files, jobs,
+                            fsync=args.fsync, written=written),
+                ))
+            elif tools.ensure("isort"):
+                py_chain.append((
+                    "[INFO] Запуск: isort (сортировка импортов)",
+                    external_step("isort", isort_args,
+                                  py_files, jobs),
+                ))
+        black_args = (f"--line-length={line_length}",)
+        if not args.skip_black:
+            black_inprocess = inprocess_black_stage(engine, line_length, py_files, cache)
+            if black_inprocess is not None:
+                py_chain.append((
+                    "[INFO] Запуск: black (форматирование кода, в процессе)",
+                    partial(run_stage_in_executor, "black", black_inprocess, py_files, jobs,
+                            fsync=args.fsync, written=written),
+                ))
+            elif tools.ensure("black"):
+                py_chain.append((
+                    "[INFO] Запуск: black (форматирование кода)",
+                    external_step("black", black_args,
+                                  py_files, jobs),
+                ))
     if sh_files:
-        sh_targets = [str(p) for p in sh_files]
-        if not args.skip_shellcheck and ensure_tool("shellcheck", None, allow_install):
-            print("[INFO] Запуск: shellcheck (анализ скриптов)")
-            run_command(["shellcheck", *sh_targets])
-        if not args.skip_shfmt and ensure_tool("shfmt", None, allow_install):
-            print("[INFO] Запуск: shfmt (форматирование скриптов)")
-            run_command(["shfmt", "-w", "-i", "4", *sh_targets])
+        if not args.skip_shellcheck and tools.ensure("shellcheck"):
+            sh_chain.append((
+                "[INFO] Запуск: shellcheck (анализ скриптов)",
+                external_step("shellcheck", (), sh_files, jobs, diagnostics=True, ok_codes=(0, 1)),
+            ))
+        if "sh" not in formatted_types and not args.skip_shfmt and tools.ensure("shfmt"):
+            sh_chain.append((
+                "[INFO] Запуск: shfmt (форматирование скриптов)",
+                external_step("shfmt", ("-w", "-i", "4"), sh_files, jobs),
+            ))
+    return [chain for chain in (py_chain, sh_chain) if chain]
+
+def apply_formatting_tools(
+    files: Dict[str, List[Path]],
+    args: argparse.Namespace,
+    formatted_types: Set[str] = frozenset(),
+    tools: Optional[ToolManager] = None,
+    cache: Optional[ToolResultCache] = None,
+    written: Optional[List[Path]] = None,
+) -> Set[Path]:
+    """Применяет линтеры и форматтеры к файлам.
+
+    Цепочки .py (ruff → isort → black) и .sh (shellcheck → shfmt) выполняются
+    одновременно. formatted_types — типы файлов, уже отформатированные в памяти (--pipeline).
+    written пополняется файлами, записанными самим скриптом (для --fsync batch).
+    Возвращает файлы, которые хотя бы один инструмент не смог обработать.
+    """
+    jobs = args.tool_jobs if args.tool_jobs > 0 else (os.cpu_count() or 1)
+    if tools is None:
+        tools = ToolManager(
+            args.cache_dir or Path.cwd() / STATE_CACHE_DIRNAME, args.wheelhouse, not args.no_install
+        )
+    chains = build_tool_chains(files, args, formatted_types, jobs, tools, cache, written)
+    if not chains:
+        return set()
+    return {Path(target) for target in asyncio.run(run_tool_chains(chains, jobs))}
+
+PRECOMPRESS_TYPES = ("html", "css", "js", "svg")
+
+def precompress_encoders() -> Dict[str, Callable[[bytes], bytes]]:
+    """Возвращает доступные кодировщики: .gz всегда, .br — если установлен brotli."""
+    encoders: Dict[str, Callable[[bytes], bytes]] = {
+        ".gz": partial(gzip.compress, compresslevel=9, mtime=0),
+    }
+    brotli = import_formatter("brotli")
+    if brotli is not None:
+        encoders[".br"] = partial(brotli.compress, quality=11)
+    return encoders
+
+class PrecompressManifest:
+    """Хранит хеши исходников, для которых уже записаны сжатые копии."""
+
+    def __init__(self, cache_dir: Path):
+        self.path = cache_dir / "precompressed.json"
+        try:
+            self.entries: Dict[str, str] = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_fresh(self, sibling: Path, digest: str) -> bool:
+        """Проверяет, что сжатая копия существует и построена из того же содержимого."""
+        return self.entries.get(str(sibling)) == digest and sibling.exists()
+
+    def save(self) -> None:
+        """Сохраняет манифест (ошибки записи игнорируются)."""
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(self.path, json.dumps(self.entries, indent=2, sort_keys=True).encode("utf-8"))
+        except OSError:
+            pass
+
+def precompress_file(
+    path: Path,
+    encoders: Dict[str, Callable[[bytes], bytes]],
+    manifest: PrecompressManifest,
+    dry_run: bool,
+) -> Tuple[str, List[Path]]:
+    """Записывает устаревшие сжатые копии файла; возвращает хеш и список записанных копий."""
+    data = path.read_bytes()
+    digest = content_hash(data)
+    written: List[Path] = []
+    for suffix, encode in encoders.items():
+        sibling = path.with_name(path.name + suffix)
+        if manifest.is_fresh(sibling, digest):
+            continue
+        if not dry_run:
+            atomic_write_bytes(sibling, encode(data))
+        written.append(sibling)
+    return digest, written
+
+def apply_precompression(
+    files: Dict[str, List[Path]],
+    cache_dir: Path,
+    dry_run: bool,
+    exclude: AbstractSet[Path] = frozenset(),
+) -> None:
+    """Создаёт .gz (и .br) копии веб-файлов параллельно, пропуская неизменённые."""
+    targets = [
+        path for file_type in PRECOMPRESS_TYPES
+        for path in files.get(file_type, []) if path not in exclude
+    ]
+    if not targets:
+        return
+    encoders = precompress_encoders()
+    if ".br" not in encoders:
+        print("[INFO] Модуль brotli не установлен, создаются только .gz копии.")
+    manifest = PrecompressManifest(cache_dir)
+    written_count = 0
+    with ThreadPoolExecutor(max_workers=default_workers()) as pool:
+        futures = {
+            pool.submit(precompress_file, path, encoders, manifest, dry_run): path
+            for path in targets
+        }
+        for future in as_completed(futures):
+            try:
+                digest, written = future.result()
+            except Exception as e:
+                print(f"[ERROR] Не удалось сжать {futures[future]}: {e}", file=sys.stderr)
+                continue
+            for sibling in written:
+                if dry_run:
+                    print(f"  - [СОЖМЁТСЯ] {display_path(sibling)}")
+                else:
+                    manifest.entries[str(sibling)] = digest
+            written_count += len(written)
+    if not dry_run:
+        manifest.save()
+    print(f"[INFO] Сжатых копий записано: {written_count} (для {len(targets)} файлов).")
 
 def main(argv: Iterable[str] = None) -> int:
     parser = argparse.ArgumentParser(
@@ -230,73 +3017,252 @@ def main(argv: Iterable[str] = None) -> int:
     parser.add_argument("--dry-run", action="store_true", help="Показать изменения без записи на диск.")
     parser.add_argument("--only-comments", action="store_true", help="Только удалять комментарии, пропустить форматтеры.")
     parser.add_argument("--no-install", action="store_true", help="Не устанавливать автоматически отсутствующие инструменты.")
+    parser.add_argument("--wheelhouse", type=Path, default=None, metavar="DIR",
+                        help="Каталог с колёсами для офлайн-установки инструментов в кешированное venv.")
     parser.add_argument("--line-length", type=int, default=88, help="Длина строки для форматтеров.")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="Исключить пути по шаблону в синтаксисе .gitignore (можно повторять).")
+    parser.add_argument("--no-gitignore", action="store_true",
+                        help="Не учитывать файлы .gitignore при поиске файлов.")
+    parser.add_argument("--discovery", choices=["auto", "git", "walk"], default="auto",
+                        help="Способ поиска файлов: git ls-files, обход каталогов или auto.")
+    parser.add_argument("--since", metavar="REV", default=None,
+                        help="Обрабатывать только файлы, изменённые относительно ревизии git.")
+    parser.add_argument("--staged", action="store_true",
+                        help="Обрабатывать только проиндексированные (git add) файлы.")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="Не пропускать файлы без маркеров комментариев (проверка по байтам).")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Число процессов для удаления комментариев (0 = по числу ядер).")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Удалять комментарии и форматировать .py/.sh в памяти, записывая файл один раз.")
+    parser.add_argument("--tool-engine", choices=["auto", "inprocess", "subprocess"], default="auto",
+                        help="Запуск black/isort: как библиотек в процессе (auto — если установлены) "
+                             "или отдельными процессами.")
+    parser.add_argument("--tool-jobs", type=int, default=0,
+                        help="Число параллельных запусков форматтеров (0 = по числу ядер).")
+    parser.add_argument("--tool-cache", action="store_true",
+                        help="Кешировать результаты black/isort/shellcheck/shfmt по хешу содержимого "
+                             "(shellcheck выводит диагностику в формате gcc).")
+    parser.add_argument("--tool-cache-size", type=int, default=256, metavar="MB",
+                        help="Максимальный размер кеша результатов инструментов в МБ.")
+    parser.add_argument("--indent", choices=INDENT_POLICIES, default="keep",
+                        help="Ведущие отступы: keep — не трогать, spaces — табуляции в пробелы, "
+                             "tabs — пробелы в табуляции (<pre>, <textarea> и многострочные строки Python "
+                             "не трогаются; осторожно с <<- в shell).")
+    parser.add_argument("--tab-size", type=int, default=4, help="Ширина табуляции для --indent.")
+    parser.add_argument("--final-newline", choices=FINAL_NEWLINE_POLICIES, default="ensure",
+                        help="Перевод строки в конце файла: ensure — добавить, keep — как в исходном файле, "
+                             "strip — убрать.")
+    parser.add_argument("--newline", choices=NEWLINE_POLICIES, default="preserve",
+                        help="Переводы строк при записи: preserve — как в исходном файле, lf или crlf.")
+    parser.add_argument("--fsync", choices=FSYNC_MODES, default="none",
+                        help="Сброс записанных файлов на диск: none — только атомарная замена, "
+                             "file — fsync каждого файла при записи, batch — fsync файлов и их каталогов "
+                             "в конце пакета.")
+    parser.add_argument("--recheck-stat", action="store_true",
+                        help="Перед записью проверять по stat, что файл не изменили во время обработки.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Пропускать файлы, не изменившиеся с прошлого запуска.")
+    parser.add_argument("--cache-dir", type=Path, default=None,
+                        help=f"Каталог кеша состояния (по умолчанию: ./{STATE_CACHE_DIRNAME}).")
 
     web_group = parser.add_argument_group("Web (.html, .css, .js) options")
     web_group.add_argument("--skip-html", action="store_true", help="Пропустить .html файлы.")
     web_group.add_argument("--skip-css", action="store_true", help="Пропустить .css файлы.")
     web_group.add_argument("--skip-js", action="store_true", help="Пропустить .js файлы.")
+    web_group.add_argument("--web-engine", choices=sorted(WEB_COMMENT_ENGINES), default="lexer",
+                           help="Способ удаления комментариев в CSS/JS: lexer (потоковый лексер, "
+                                "учитывает строки, шаблоны и регулярные выражения) или regex (прежние регулярки).")
+    web_group.add_argument("--minify", action="store_true",
+                           help="Дополнительно сжимать пробелы в .html/.css/.js с учётом контекста токенов "
+                                "(<pre>, <textarea> и строковые литералы не трогаются).")
+    web_group.add_argument("--stream-threshold", type=int, default=64, metavar="MB",
+                           help="Файлы .html/.css/.js от этого размера обрабатываются потоково окнами "
+                                "mmap с памятью O(окна); 0 — отключить (только с --web-engine lexer).")
+    web_group.add_argument("--stream-chunk", type=int, default=STREAM_CHUNK_SIZE // 1024, metavar="KB",
+                           help="Размер окна потоковой обработки в КБ.")
+    web_group.add_argument("--precompress", action="store_true",
+                           help="Создавать рядом с .html/.css/.js/.svg сжатые копии .gz (и .br, если "
+                                "установлен brotli); неизменённые файлы пропускаются.")
 
     py_group = parser.add_argument_group("Python (.py) options")
     py_group.add_argument("--skip-ruff", action="store_true", help="Пропустить ruff.")
     py_group.add_argument("--skip-isort", action="store_true", help="Пропустить isort.")
     py_group.add_argument("--skip-black", action="store_true", help="Пропустить black.")
+    py_group.add_argument("--py-toolchain", choices=["classic", "ruff"], default="classic",
+                          help="classic — ruff + isort + black; ruff — один ruff "
+                               "(check --select F,I --fix и ruff format).")
+    py_group.add_argument("--py-engine", choices=sorted(PY_COMMENT_ENGINES), default="splice",
+                          help="Способ удаления комментариев в Python: splice (по смещениям токенов) "
+                               "или untokenize (пересборка из токенов).")
     py_group.add_argument("--keep-py-keywords", type=str, default=",".join(sorted(DEFAULT_KEEP_PY_COMMENT_KEYWORDS)),
-                          help="Ключевые слова для сохранения комментариев в Python (через запятую).")
+                          help="Ключевые слова для сохранения комментариев в Python (через запятую; "
+                               "^слово — только в начале комментария, re:шаблон — регулярное выражение).")
 
     sh_group = parser.add_argument_group("Shell (.sh) options")
     sh_group.add_argument("--skip-sh", action="store_true", help="Пропустить .sh файлы.")
     sh_group.add_argument("--skip-shellcheck", action="store_true", help="Пропустить shellcheck.")
     sh_group.add_argument("--skip-shfmt", action="store_true", help="Пропустить shfmt.")
     sh_group.add_argument("--keep-sh-keywords", type=str, default=",".join(sorted(DEFAULT_KEEP_SH_COMMENT_KEYWORDS)),
-                          help="Ключевые слова для сохранения комментариев в Shell (через запятую).")
+                          help="Ключевые слова для сохранения комментариев в Shell (через запятую; "
+                               "^слово и re:шаблон — как для Python).")
 
     args = parser.parse_args(list(argv) if argv is not None else None)
     targets = [p.resolve() for p in args.paths] if args.paths else [Path.cwd()]
-    source_files = discover_source_files(targets)
+    if args.since or args.staged:
+        try:
+            source_files = discover_changed_files(targets, args.since, args.staged, args.exclude)
+        except RuntimeError as e:
+            print(f"[ERROR] Не удалось получить список изменённых файлов: {e}", file=sys.stderr)
+            return 2
+    else:
+        source_files = discover_source_files(
+            targets, excludes=args.exclude, use_gitignore=not args.no_gitignore,
+            backend=args.discovery,
+        )
 
     if not any(source_files.values()):
         print("[INFO] Не найдено поддерживаемых файлов для обработки.")
         return 0
 
-    py_keep_kw = {kw.strip().lower() for kw in args.keep_py_keywords.split(",") if kw.strip()}
-    sh_keep_kw = {kw.strip().lower() for kw in args.keep_sh_keywords.split(",") if kw.strip()}
+    cache_dir = args.cache_dir or Path.cwd() / STATE_CACHE_DIRNAME
+    tools = ToolManager(cache_dir, args.wheelhouse, not args.no_install)
+    if not args.only_comments:
+        tools.prepare(required_tools(source_files, args))
+
+    state: Optional[StateCache] = None
+    if args.incremental:
+        tool_versions = None
+        if not args.only_comments:
+            tool_versions = toolchain_versions(tools, required_tools(source_files, args), args.tool_engine)
+        state = StateCache(cache_dir, config_fingerprint(args, tool_versions))
+        source_files, unchanged_count = partition_by_state(source_files, state)
+        print(f"[INFO] Пропущено неизменённых файлов (--incremental): {unchanged_count}")
+
+    try:
+        py_keep_kw = compile_keep_matcher(parse_keep_keywords(args.keep_py_keywords))
+        sh_keep_kw = compile_keep_matcher(parse_keep_keywords(args.keep_sh_keywords))
+    except re.error as e:
+        print(f"[ERROR] Некорректное регулярное выражение в ключевых словах: {e}", file=sys.stderr)
+        return 2
 
     processors = {
-        "py": (lambda src: strip_python_comments(src, py_keep_kw), not source_files.get("py")),
-        "sh": (lambda src: strip_shell_comments(src, sh_keep_kw), args.skip_sh),
-        "html": (strip_html_comments, args.skip_html),
-        "css": (strip_css_comments, args.skip_css),
-        "js": (strip_js_comments, args.skip_js),
+        "py": (partial(strip_python_comments, keep_keywords=py_keep_kw, engine=args.py_engine), not source_files.get("py")),
+        "sh": (partial(strip_shell_comments, keep_keywords=sh_keep_kw), args.skip_sh),
+        "html": (partial(strip_html_comments, minify=args.minify), args.skip_html),
+        "css": (partial(strip_css_comments, engine=args.web_engine, minify=args.minify), args.skip_css),
+        "js": (partial(strip_js_comments, engine=args.web_engine, minify=args.minify), args.skip_js),
     }
 
+    tool_cache: Optional[ToolResultCache] = None
+    if args.tool_cache and not args.only_comments:
+        tool_cache = ToolResultCache(cache_dir, args.tool_cache_size * 1024 * 1024)
+
+    pipeline_stages: Dict[str, Tuple[PipelineStage, ...]] = {}
+    if args.pipeline and not args.only_comments:
+        pipeline_stages = build_pipeline_stages(source_files, args, tools, tool_cache)
+        if args.skip_sh and pipeline_stages.get("sh"):
+            processors["sh"] = (strip_nothing, False)
+
+    whitespace = WhitespacePolicy(args.indent, args.tab_size, args.final_newline, args.newline)
+    streamers: Dict[str, Callable[..., Optional[FileResult]]] = {}
+    if args.stream_threshold > 0 and args.web_engine == "lexer":
+        for file_type in ("html", "css", "js"):
+            streamers[file_type] = partial(
+                stream_web_file, language=file_type, minify=args.minify,
+                chunk_size=args.stream_chunk * 1024, threshold=args.stream_threshold * 1024 * 1024,
+            )
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
     changed_count = 0
-    for file_type, (processor_func, skip) in processors.items():
-        if skip:
-            continue
-        files_to_process = source_files.get(file_type, [])
-        if not files_to_process:
-            continue
+    saved_bytes = 0
+    whitespace_lines = 0
+    written_files: List[Path] = []
+    known_states: Dict[Path, FileState] = {}
+    failed_files: Set[Path] = set()
+    tool_failures: Set[Path] = set()
+    try:
+        for file_type, (processor_func, skip) in processors.items():
+            if skip:
+                continue
+            files_to_process = source_files.get(file_type, [])
+            if not files_to_process:
+                continue
 
-        print(f"[INFO] Обработка {len(files_to_process)} .{file_type} файлов...")
-        for file_path in files_to_process:
-            try:
-                original = file_path.read_text(encoding="utf-8")
-                cleaned = processor_func(original)
-                if write_if_changed(file_path, cleaned, args.dry_run):
-                    if args.dry_run:
-                        print(f"  - [ИЗМЕНИТСЯ] {file_path.relative_to(Path.cwd())}")
+            print(f"[INFO] Обработка {len(files_to_process)} .{file_type} файлов...")
+            stages = pipeline_stages.get(file_type, ())
+            markers = None
+            minified = args.minify and file_type in MINIFY_TYPES
+            if (not args.no_prefilter and not stages and not minified
+                    and whitespace == DEFAULT_WHITESPACE_POLICY):
+                if file_type != "py" or args.py_engine == "splice":
+                    markers = PREFILTER_MARKERS[file_type]
+            results = process_files(
+                files_to_process, processor_func, args.dry_run, pool, jobs, stages, markers,
+                args.fsync, args.recheck_stat, whitespace, streamers.get(file_type),
+            )
+            for file_path, result in zip(files_to_process, results):
+                if result.state is not None:
+                    known_states[file_path] = result.state
+                for message in result.tool_errors:
+                    print(f"[WARN] {display_path(file_path)}: {message}", file=sys.stderr)
+                    tool_failures.add(file_path)
+                if result.error is not None:
+                    print(f"[ERROR] Не удалось обработать файл {file_path}: {result.error}", file=sys.stderr)
+                    failed_files.add(file_path)
+                elif result.changed:
+                    if minified:
+                        print(f"  - [MINIFY] {display_path(file_path)}: -{result.saved} байт")
+                        saved_bytes += result.saved
+                    elif args.dry_run:
+                        print(f"  - [ИЗМЕНИТСЯ] {display_path(file_path)}")
+                    if result.whitespace.lines:
+                        print(f"  - [WHITESPACE] {display_path(file_path)}: "
+                              f"строк {result.whitespace.lines}, байт {result.whitespace.delta:+d}")
+                        whitespace_lines += result.whitespace.lines
                     changed_count += 1
-            except Exception as e:
-                print(f"[ERROR] Не удалось обработать файл {file_path}: {e}", file=sys.stderr)
+                    written_files.append(file_path)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     if args.dry_run:
         print(f"\n[DRY-RUN] Будет изменено файлов после удаления комментариев: {changed_count}")
     else:
         print(f"\n[INFO] Изменено файлов (удаление комментариев): {changed_count}")
+    if args.minify:
+        print(f"[INFO] Сэкономлено байт (--minify): {saved_bytes}")
+    if whitespace_lines:
+        print(f"[INFO] Строк изменено политикой пробелов: {whitespace_lines}")
 
     if not args.only_comments:
-        apply_formatting_tools(source_files, args)
+        formatted_types = {t for t, stages in pipeline_stages.items() if stages}
+        tool_failures |= apply_formatting_tools(
+            source_files, args, formatted_types, tools, tool_cache, written_files
+        )
+
+    if args.precompress:
+        apply_precompression(source_files, cache_dir, args.dry_run, failed_files)
+
+    if args.fsync == "batch" and written_files and not args.dry_run:
+        synced = sync_written_files(written_files)
+        print(f"[INFO] Изменения сброшены на диск (каталогов: {synced}).")
+
+    if tool_cache is not None:
+        tool_cache.evict()
+
+    if state is not None:
+        if not args.dry_run:
+            for file_path in (p for paths in source_files.values() for p in paths):
+                if file_path in failed_files or file_path in tool_failures:
+                    continue
+                try:
+                    state.record(file_path, known_states.get(file_path))
+                except OSError:
+                    pass
+        state.close()
 
     print("\n[DONE] Завершено.")
     return 0